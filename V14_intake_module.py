@@ -3,7 +3,7 @@ import os
 from pathlib import Path
 import PyPDF2
 import pandas as pd
-import requests
+import rss_client_module as rss
 from openpyxl import load_workbook
 from settings_RSS import Settings
 
@@ -228,7 +228,7 @@ def create_account(new_dict):
     payload = json.dumps(new_dict)
     print(payload)
     headers = settings.posting_headers
-    response = requests.post(settings.accounts_url, headers=headers, data=payload)
+    response = rss.post(settings.accounts_url, headers=headers, data=payload)
     print(response)
     print(response.status_code)
     print(response.reason)
@@ -250,13 +250,13 @@ def patch_account(new_dict):
     parameters = json.dumps(parameters)
     url = f"{settings.accounts_url}?q={parameters}"
     headers = settings.posting_headers
-    r = requests.get(url, headers=headers)
+    r = rss.get(url, headers=headers)
     # If account exists find accountid and create new account
     if r.json()['metadata']['total_count'] != 0:
         account_id = r.json()['list'][0]['record']['id']
         url = f"{settings.documents_url}/{account_id}"
         payload = json.dumps(new_dict)
-        response = requests.patch(url, headers=headers, data=payload)
+        response = rss.patch(url, headers=headers, data=payload)
         if response.status_code == 201:
             print(f"{response} - {new_dict['name']} Account Patched!")
         else:
@@ -431,7 +431,7 @@ def download_documents(auth, document_ids):
         try:
         #for i in document_ids:
             # get information about the document.
-            r = requests.get(f'https://apiv4.reallysimplesystems.com/documents/{i}/content',
+            r = rss.get(f'https://apiv4.reallysimplesystems.com/documents/{i}/content',
                              headers=auth)
             print(f"{r} - Document {i} Downloaded")
             # identify document's content-disposition.
@@ -446,7 +446,7 @@ def download_documents(auth, document_ids):
         except AttributeError:
             # If there's an attribute error, print an error message.
             print("We couldn't find a filename for document id.")
-            r = requests.get(f'https://apiv4.reallysimplesystems.com/documents/{i}/content',
+            r = rss.get(f'https://apiv4.reallysimplesystems.com/documents/{i}/content',
                              headers=auth)
             open("unknown", 'wb').write(r.content)
 
@@ -463,7 +463,7 @@ def populate_document_ids(auth):
     while True:
         # request page of data from rss
         url = f"{settings.documents_url}{settings.record_limit}&page={page}"
-        r = requests.get(url, headers=auth)
+        r = rss.get(url, headers=auth)
 
         for record in r.json()['list']:
             # identify record id
@@ -486,7 +486,7 @@ def delete_documents_from_rss(auth, document_ids):
     :return:
     """
     for i in document_ids:
-        r = requests.delete(
+        r = rss.delete(
             f'https://apiv4.reallysimplesystems.com/documents/{i}',
             headers=auth)
         print(f"{r} - Document ID: {i} Deleted from RSS.")
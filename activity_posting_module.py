@@ -1,7 +1,8 @@
 import pandas as pd
 import google_module as gm
 from settings_RSS import Settings
-import requests
+import rss_client_module as rss
+import api_budget_module as abm
 import json
 
 settings = Settings()
@@ -31,12 +32,15 @@ def format_training_status_activity_dict(completers_df, new_completer_list):
     return new_completer_df[['accountid', 'type', 'trainingprogram', 'startdate', 'trainingstatus']].to_dict('index')
 
 def post_dictionary_activities(dict):
+    if abm.remaining_api_calls() < len(dict):
+        print(f"Not enough API budget to post {len(dict)} activities. They will be posted on the next run.")
+        return
     failed_posts = 0
     for total_requests, (k, v) in enumerate(dict.items(), start=1):
         v['date'] = str(pd.Timestamp.today())
         json_string = json.dumps(v)
         url = f"{settings.activities_url}"
-        r = requests.post(url,data=json_string,headers=settings.posting_headers)
+        r = rss.post(url,data=json_string,headers=settings.posting_headers)
         print(r.status_code)
         if r.status_code != 201:
             print(f"Activity type: {v['type']} for client ID: {v['accountid']} failed to post")
@@ -0,0 +1,135 @@
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime as dt
+from settings_RSS import Settings
+
+settings = Settings()
+
+
+class ApiBudgetExhausted(KeyError):
+    """
+    Raised when the daily or monthly API budget has been spent. Subclasses KeyError so the existing handlers for
+    exhausted API usage catch it.
+    """
+
+
+class TokenBucket:
+    """A thread safe token bucket that limits how quickly RSS API requests are sent."""
+
+    def __init__(self, rate, capacity):
+        """
+        Initialize a full token bucket.
+        :param rate: Tokens added per second.
+        :param capacity: Maximum number of tokens, i.e. the largest burst of requests allowed.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a token is available and take it.
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = None if settings.api_requests_per_second is None else TokenBucket(settings.api_requests_per_second,
+                                                                                  settings.api_burst_size)
+usage_lock = threading.Lock()
+
+
+def read_api_usage():
+    """
+    Read the persisted API usage, starting new counts when the day or month has changed.
+    :return: Dictionary of daily and monthly API usage.
+    """
+    today = dt.now()
+    usage = {}
+    if os.path.exists(settings.api_usage_history):
+        with open(settings.api_usage_history) as f:
+            usage = json.load(f)
+    if usage.get('Day') != today.strftime('%Y-%m-%d'):
+        usage['Day'] = today.strftime('%Y-%m-%d')
+        usage['Daily Calls'] = 0
+    if usage.get('Month') != today.strftime('%Y-%m'):
+        usage['Month'] = today.strftime('%Y-%m')
+        usage['Monthly Calls'] = 0
+    return usage
+
+
+def remaining_api_calls(usage=None):
+    """
+    Calculate how many API calls are left in the daily and monthly budgets.
+    :param usage: Dictionary of API usage. Default=None reads the persisted usage.
+    :return: Number of API calls that can still be made, infinite if no limit is set.
+    """
+    if usage is None:
+        usage = read_api_usage()
+    remaining = [math.inf]
+    if settings.daily_api_limit is not None:
+        remaining.append(settings.daily_api_limit - usage['Daily Calls'])
+    if settings.monthly_api_limit is not None:
+        remaining.append(settings.monthly_api_limit - usage['Monthly Calls'])
+    return min(remaining)
+
+
+def acquire_api_call():
+    """
+    Reserve a single API call, waiting on the rate limiter and recording the call in the persisted usage.
+    :return:
+    """
+    with usage_lock:
+        usage = read_api_usage()
+        if remaining_api_calls(usage) <= 0:
+            raise ApiBudgetExhausted(f"API budget exhausted: {usage['Daily Calls']} calls today, "
+                                     f"{usage['Monthly Calls']} calls this month.")
+        usage['Daily Calls'] += 1
+        usage['Monthly Calls'] += 1
+        with open(settings.api_usage_history, 'w') as f:
+            json.dump(usage, f)
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+
+
+def estimate_page_calls(total_count):
+    """
+    Estimate the number of API calls needed to page through a number of records.
+    :param total_count: Total number of records reported by the API's metadata.
+    :return: Number of page requests.
+    """
+    return math.ceil(int(total_count) / settings.records_per_page)
+
+
+def split_by_budget(planned_calls):
+    """
+    Schedule work in priority order until the remaining budget runs out. Work that doesn't fit is deferred.
+    :param planned_calls: List of (name, estimated calls) tuples, highest priority first.
+    :return: List of scheduled names and list of deferred names.
+    """
+    remaining = remaining_api_calls()
+    scheduled = []
+    deferred = []
+    for name, calls in planned_calls:
+        if calls <= remaining:
+            scheduled.append(name)
+            remaining -= calls
+        else:
+            deferred.append(name)
+    if len(deferred) > 0:
+        print(f"API budget is short, {remaining} calls remaining. Deferred: {deferred}")
+    return scheduled, deferred
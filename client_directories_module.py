@@ -85,7 +85,7 @@ def update_coach_directories(dataframe):
             settings.coach_directories[i], 'Data',
             dataframe[
                 (dataframe['Case Manager'] == f"{settings.coach_initials[i]}") &
-                (pd.to_datetime(dataframe['Original Intake Date']) >= (pd.Timestamp('today') - timedelta(days=730)))])
+                (dataframe['Original Intake Date'] >= (pd.Timestamp('today') - timedelta(days=730)))])
 
     if settings.username == "Fred":
         for i in range(len(settings.coach_initials)):
@@ -93,7 +93,7 @@ def update_coach_directories(dataframe):
                 settings.od_coach_directories[i], 'Data',
                 dataframe[
                     (dataframe['Case Manager'] == f"{settings.coach_initials[i]}") &
-                    (pd.to_datetime(dataframe['Original Intake Date']) >= (
+                    (dataframe['Original Intake Date'] >= (
                                 pd.Timestamp('today') - timedelta(days=730)))])
 
 def update_complete_client_directory(df):
@@ -102,7 +102,7 @@ def update_complete_client_directory(df):
     :param df:
     :return:
     """
-    directory_df = df[pd.to_datetime(df['Original Intake Date'], errors='coerce') >= pd.to_datetime('2019-07-01')]
+    directory_df = df[df['Original Intake Date'] >= pd.Timestamp('2019-07-01')]
     write_excel(settings.complete_client_directory, 'Data', directory_df)
 
     if settings.username == "Fred":
@@ -116,6 +116,6 @@ def update_client_directories():
     :return:
     """
     df = pd.read_csv(settings.reporting_df_csv)
-    df = dmm.coerce_to_datetime(df,'Original Intake Date','Cohort Date')
+    df = dmm.coerce_to_datetime(df,'Original Intake Date','Cohort Date', date_format=settings.report_date_format)
     update_complete_client_directory(df)
     update_coach_directories(df)
@@ -1,19 +1,28 @@
 import json
+import math
+import os
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import requests
+import api_budget_module as abm
+import rss_client_module as rss
+import local_store_module as lsm
 from settings_RSS import Settings
 from datetime import datetime as dt
 
 settings = Settings()
 
+checkpoint_lock = threading.Lock()
+
 
 def get_last_call_date():
     """
     Retrieve the last call date from the call history file.
     :return: Date of last recorded api call.
     """
-    with open(settings.call_history) as f:
-        decoded = json.load(f)
+    decoded = read_call_history()
     return decoded['Last Call Date']
 
 
@@ -50,20 +59,33 @@ def set_parameters_by_record_type(record_type, field, last_call_date, expression
     return parameters
 
 
-def check_created_records(last_call_date, record_type, activity_type=''):
+def check_delta_records(last_call_date, record_type, activity_type=''):
     """
-    Check how many accounts have been modified since last update.
+    Check how many records have been created or modified since last update.
     :param last_call_date: Date of most recent API call date.
     :param record_type: Accounts or Activities
-    :param activity_type: Type of activity requested if record type is activity.
-    :return: The number of records that have been created since the last API call date.
+    :param activity_type: Type of activity requested if record type is activity. Default=''
+    :return: The number of records that have been created or modified since the last API call date.
     """
-    parameters = set_parameters_by_record_type(record_type, "createddate", last_call_date, "$gte", activity_type)
+    parameters = set_parameters_by_record_type(record_type, "modifieddate", last_call_date, "$gte", activity_type)
     url = record_type + f"?q={parameters}"
-    r = requests.get(url, headers=settings.fred_authorization).json()
-    records_created = r['metadata']['total_count']
-    print(f"-{records_created} Records Have Been Created.")
-    return records_created
+    r = rss.get(url, headers=settings.fred_authorization).json()
+    delta_records = r['metadata']['total_count']
+    print(f"-{delta_records} Records Have Been Created Or Modified.")
+    return delta_records
+
+
+def format_page_url(record_type, page, parameter=''):
+    """
+    Build the url for a single page of records.
+    :param record_type: Accounts or Activities
+    :param page: Page number requested.
+    :param parameter: Parameters applied API request if any. Default=''
+    :return: Url of the requested page.
+    """
+    if parameter == '':
+        return record_type + f"?limit={settings.records_per_page}&page={page}"
+    return record_type + f"?q={parameter}&limit={settings.records_per_page}&page={page}"
 
 
 def pagination_loop(record_type, parameter=''):
@@ -78,12 +100,8 @@ def pagination_loop(record_type, parameter=''):
         frames = []
         print("\nLooping Through API URL Pages")
         while True:
-            if parameter == '':
-                url = record_type + f"?limit=100&page={page}"
-            else:
-                url = record_type + f"?q={parameter}&limit=100&page" \
-                                    f"={page}"
-            r = requests.get(
+            url = format_page_url(record_type, page, parameter)
+            r = rss.get(
                 url, headers=settings.fred_authorization).json()
             record_list = [i['record'] for i in r['list']]
             df = pd.DataFrame(record_list)
@@ -100,142 +118,385 @@ def pagination_loop(record_type, parameter=''):
         print("Check API Usage")
 
 
-def update_created_records(record_type, last_call_date, activity_type=''):
+def request_page(record_type, page, parameter='', checkpoint_dir=None):
     """
-    Update the records for all accounts that had been modified since the last call date.
-    :param record_type: Accounts or  Activities
-    :param last_call_date: Date of last recorded API call.
-    :param activity_type: The type of activity requested if record_type is activities. Default=''
-    :return:
+    Request a single page of records. When checkpointing, pages already saved by an interrupted sync are read from
+    disk instead of being requested again, and newly requested pages are saved.
+    :param record_type: Accounts or Activities
+    :param page: Page number requested.
+    :param parameter: Parameters applied API request if any. Default=''
+    :param checkpoint_dir: Directory where pages of this request are saved. Default=None
+    :return: Dataframe made up of the records on the requested page.
     """
-    if record_type == settings.accounts_url:
-        csv_file = settings.accounts_csv
-    else:
-        csv_file = settings.activities_csv
-    parameters = set_parameters_by_record_type(
-        record_type, "createddate", last_call_date, "$gte", activity_type)
-    created_accounts_df = pagination_loop(
-        record_type, parameter=parameters)
-    previous_accounts_df = pd.read_csv(csv_file)
-    df_list = [previous_accounts_df, created_accounts_df]
-    updated_df = pd.concat(df_list)
-    updated_df.to_csv(csv_file, index=False)
+    if checkpoint_dir is not None:
+        page_file = os.path.join(checkpoint_dir, f"page_{page}.csv")
+        if os.path.exists(page_file):
+            return pd.read_csv(page_file)
+    url = format_page_url(record_type, page, parameter)
+    r = rss.get(url, headers=settings.fred_authorization).json()
+    df = pd.DataFrame([i['record'] for i in r['list']])
+    if checkpoint_dir is not None:
+        df.to_csv(f"{page_file}.tmp", index=False)
+        os.replace(f"{page_file}.tmp", page_file)
+    return df
 
 
-def check_modified_records(last_call_date, record_type, activity_type=''):
+def concurrent_pagination_loop(record_type, total_count, parameter='', max_workers=None, checkpoint_dir=None):
     """
-    Check how many accounts have been modified since last update.
-    :param last_call_date: Date of last recorded API call.
+    Request every page of records at once, limited by a maximum number of concurrent requests.
     :param record_type: Accounts or Activities
-    :param activity_type: Type of activity requested if record type is Activity. Default=''
-    :return: The number of records modified since the last API call.
+    :param total_count: Total number of records reported by the API's metadata.
+    :param parameter: Parameters applied API request if any. Default=''
+    :param max_workers: Maximum number of concurrent requests. Default=settings.max_concurrent_requests
+    :param checkpoint_dir: Directory where pages of this request are saved. Default=None
+    :return: Dataframe comprised of requested data, in page order.
     """
-    parameters = set_parameters_by_record_type(
-        record_type, "modifieddate", last_call_date, "$gte", activity_type)
-    url = record_type + f"?q={parameters}"
-    r = requests.get(url, headers=settings.fred_authorization).json()
-    records_modified = r['metadata']['total_count']
-    print(f"-{records_modified} Records Have Been Modified.")
-    return records_modified
+    if max_workers is None:
+        max_workers = settings.max_concurrent_requests
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    pages = range(1, math.ceil(int(total_count) / settings.records_per_page) + 1)
+    try:
+        print(f"\nRequesting {len(pages)} API URL Pages")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # executor.map returns results in the order pages were submitted.
+            frames = list(executor.map(lambda page: request_page(record_type, page, parameter, checkpoint_dir),
+                                       pages))
+        if len(frames) == 0:
+            return pd.DataFrame()
+        df = pd.concat(frames)
+        print(f"\nDataframe contains {len(df)} records.\n")
+        return df
+    except KeyError:
+        print(f"A Key Error Occurred While Requesting {parameter} records.")
+        print("Check API Usage")
+        # Saved pages are kept so the next sync can resume from them.
+        raise
 
 
-def drop_outdated_rows(df, column, condition_list):
+def iterate_pages(record_type, total_count, parameter='', start_page=1, max_workers=None):
     """
-    Drop row based on specific column and value.
-    :param df: Dataframe containing existing reporting_df and df containing recently modified accounts/activities.
-    :param column: Account ID column.
-    :param condition_list: List of Account ID's that have been modified and merged into reporting_df
-    :return: Dataframe where modified accounts/activities have replaced existing records.
+    Yield pages of records in page order while only holding a small window of pages in memory. Up to max_workers
+    pages are requested at once.
+    :param record_type: Accounts or Activities
+    :param total_count: Total number of records reported by the API's metadata.
+    :param parameter: Parameters applied API request if any. Default=''
+    :param start_page: First page to request. Default=1
+    :param max_workers: Maximum number of concurrent requests. Default=settings.max_concurrent_requests
+    :return: Generator of (page number, dataframe) tuples.
     """
-    index_names = df[df[column].isin(condition_list)].index
-    return df.drop(index_names)
+    if max_workers is None:
+        max_workers = settings.max_concurrent_requests
+    pages = range(start_page, math.ceil(int(total_count) / settings.records_per_page) + 1)
+    print(f"\nStreaming {len(pages)} API URL Pages")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for page in pages:
+            pending.append((page, executor.submit(request_page, record_type, page, parameter)))
+            if len(pending) >= max_workers:
+                page_number, future = pending.popleft()
+                yield page_number, future.result()
+        while len(pending) > 0:
+            page_number, future = pending.popleft()
+            yield page_number, future.result()
 
 
-def update_modified_records(record_type, last_call_date, activity_type=''):
+def stream_records_to_store(record_type, total_count, parameter, checkpoint, checkpoint_key):
     """
-    Update the records for all accounts that had been modified since the last call date.
+    Stream pages of records into the local store in chunks so memory stays flat however many pages there are. The
+    last page written is checkpointed so an interrupted stream resumes after it.
     :param record_type: Accounts or Activities
+    :param total_count: Total number of records reported by the API's metadata.
+    :param parameter: Parameters applied to the API request.
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :param checkpoint_key: 'Accounts' or an activity type.
+    :return: Partitions of the local store that received new records.
+    """
+    start_page = checkpoint['Streamed Pages'].get(checkpoint_key, 0) + 1
+    partitions = []
+    chunk = []
+    for page, df in iterate_pages(record_type, total_count, parameter, start_page):
+        chunk.append(df)
+        if len(chunk) >= settings.stream_chunk_pages:
+            partitions += store_delta_records(pd.concat(chunk), record_type)
+            chunk = []
+            mark_streamed_page(checkpoint, checkpoint_key, page)
+    if len(chunk) > 0:
+        partitions += store_delta_records(pd.concat(chunk), record_type)
+    return partitions
+
+
+def fetch_records(record_type, parameters, total_count=None, checkpoint_dir=None):
+    """
+    Fetch records concurrently when the total count is known, otherwise page through them one at a time.
+    :param record_type: Accounts or Activities
+    :param parameters: Parameters applied to the API request.
+    :param total_count: Total number of records reported by the API's metadata. Default=None
+    :param checkpoint_dir: Directory where pages of this request are saved. Default=None
+    :return: Dataframe comprised of requested data.
+    """
+    if total_count is None:
+        return pagination_loop(record_type, parameter=parameters)
+    return concurrent_pagination_loop(record_type, total_count, parameter=parameters, checkpoint_dir=checkpoint_dir)
+
+
+def fetch_delta_records(last_call_date, record_type, activity_type='', checkpoint_dir=None, delta_records=None):
+    """
+    Fetch every record created or modified since the last call date. New records are included because their
+    modifieddate is set when they are created.
     :param last_call_date: Date of last recorded API call.
+    :param record_type: Accounts or Activities
     :param activity_type: Type of activity requested if record type is Activities. Default=''
+    :param checkpoint_dir: Directory where pages of this request are saved. Default=None
+    :param delta_records: Number of created/modified records, if already checked. Default=None
+    :return: Dataframe of created/modified records, or None if there are none.
+    """
+    if delta_records is None:
+        delta_records = check_delta_records(last_call_date, record_type, activity_type)
+    if int(delta_records) == 0:
+        return None
+    parameters = set_parameters_by_record_type(record_type, "modifieddate", last_call_date, "$gte", activity_type)
+    return fetch_records(record_type, parameters, delta_records, checkpoint_dir)
+
+
+def read_call_history():
+    """
+    Read api_call_history.json
+    :return: Dictionary of the call history.
+    """
+    with open(settings.call_history) as f:
+        return json.load(f)
+
+
+def write_call_history(decoded):
+    """
+    Write api_call_history.json
+    :param decoded: Dictionary of the call history.
     :return:
     """
-    if record_type == settings.accounts_url:
-        csv_file = settings.accounts_csv
+    with open(settings.call_history, 'w') as f:
+        json.dump(decoded, f)
+
+
+def get_checkpoint_dir(checkpoint_key):
+    """
+    Build the directory where the pages of a record type are saved during a sync.
+    :param checkpoint_key: 'Accounts' or an activity type.
+    :return: Directory path.
+    """
+    return os.path.join(settings.sync_checkpoint_path, checkpoint_key)
+
+
+def save_sync_checkpoint(checkpoint):
+    """
+    Write the sync checkpoint to api_call_history.json. Callers hold checkpoint_lock.
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :return:
+    """
+    decoded = read_call_history()
+    decoded['Sync Checkpoint'] = checkpoint
+    write_call_history(decoded)
+
+
+def start_sync_checkpoint(last_call_date):
+    """
+    Load the checkpoint of an interrupted sync, or start a new one if the last sync finished.
+    :param last_call_date: Date of last recorded API call.
+    :return: Dictionary of the sync checkpoint.
+    """
+    with checkpoint_lock:
+        decoded = read_call_history()
+        checkpoint = decoded.get('Sync Checkpoint')
+        if checkpoint is not None and checkpoint['Last Call Date'] == last_call_date:
+            print(f"Resuming Sync Started {checkpoint['Sync Started']}. "
+                  f"Completed Record Types: {checkpoint['Completed']}")
+            checkpoint.setdefault('Streamed Pages', {})
+            return checkpoint
+        checkpoint = {'Last Call Date': last_call_date, 'Sync Started': str(dt.now()), 'Completed': [],
+                      'Streamed Pages': {}}
+        decoded['Sync Checkpoint'] = checkpoint
+        write_call_history(decoded)
+        shutil.rmtree(settings.sync_checkpoint_path, ignore_errors=True)
+    return checkpoint
+
+
+def mark_checkpoint_complete(checkpoint, checkpoint_key):
+    """
+    Record that a record type has been fully synced and discard its saved pages.
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :param checkpoint_key: 'Accounts' or an activity type.
+    :return:
+    """
+    with checkpoint_lock:
+        checkpoint['Completed'].append(checkpoint_key)
+        save_sync_checkpoint(checkpoint)
+    shutil.rmtree(get_checkpoint_dir(checkpoint_key), ignore_errors=True)
+
+
+def mark_streamed_page(checkpoint, checkpoint_key, page):
+    """
+    Record the last page of a record type that has been streamed into the local store.
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :param checkpoint_key: 'Accounts' or an activity type.
+    :param page: Last page written to the local store.
+    :return:
+    """
+    with checkpoint_lock:
+        checkpoint['Streamed Pages'][checkpoint_key] = page
+        save_sync_checkpoint(checkpoint)
+
+
+def clear_sync_checkpoint():
+    """
+    Remove the sync checkpoint once every record type has been synced.
+    :return:
+    """
+    with checkpoint_lock:
+        decoded = read_call_history()
+        decoded.pop('Sync Checkpoint', None)
+        write_call_history(decoded)
+    shutil.rmtree(settings.sync_checkpoint_path, ignore_errors=True)
+
+
+def store_delta_records(df, record_type):
+    """
+    Mark the accounts of created/modified records as dirty and append the records to the local store.
+    :param df: Dataframe of created/modified records.
+    :param record_type: Accounts or Activities url.
+    :return: Partitions of the local store that received new records.
+    """
+    if df is None or df.empty:
+        return []
+    lsm.mark_dirty_accounts(df, record_type)
+    return lsm.append_segment(df, record_type)
+
+
+def get_sync_record_types():
+    """
+    List every record type that is synced, highest priority first.
+    :return: List of (checkpoint key, record type, activity type) tuples.
+    """
+    return [('Accounts', settings.accounts_url, '')] + [(i, settings.activities_url, i) for i in settings.activity_types]
+
+
+def plan_sync(last_call_date, checkpoint):
+    """
+    Count the records each outstanding record type needs and schedule as many as the API budget allows. Record types
+    that don't fit are deferred to the next sync.
+    :param last_call_date: Date of last recorded API call.
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :return: Dictionary of scheduled checkpoint keys and their delta record counts, and a list of deferred keys.
+    """
+    delta_counts = {}
+    for checkpoint_key, record_type, activity_type in get_sync_record_types():
+        if checkpoint_key not in checkpoint['Completed']:
+            print(f"\nCounting {checkpoint_key} Records:")
+            delta_counts[checkpoint_key] = check_delta_records(last_call_date, record_type, activity_type)
+    planned_calls = [(k, abm.estimate_page_calls(v)) for k, v in delta_counts.items()]
+    print(f"Sync needs an estimated {sum(i[1] for i in planned_calls)} API calls.")
+    scheduled, deferred = abm.split_by_budget(planned_calls)
+    return {k: delta_counts[k] for k in scheduled}, deferred
+
+
+def sync_record_type(last_call_date, checkpoint, delta_counts, record_type, activity_type=''):
+    """
+    Sync a single record type into the local store, skipping it if an interrupted sync already completed it or if it
+    was deferred.
+    :param last_call_date: Date of last recorded API call.
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :param delta_counts: Dictionary of scheduled checkpoint keys and their delta record counts.
+    :param record_type: Accounts or Activities
+    :param activity_type: Type of activity requested if record type is Activities. Default=''
+    :return: Partitions of the local store that received new records.
+    """
+    checkpoint_key = activity_type if activity_type != '' else 'Accounts'
+    print(f"\nChecking {checkpoint_key} Records:")
+    if checkpoint_key in checkpoint['Completed']:
+        print(f"-{checkpoint_key} Records Were Synced Before The Last Interruption.")
+        return []
+    if checkpoint_key not in delta_counts:
+        print(f"-{checkpoint_key} Records Deferred Until The API Budget Allows.")
+        return []
+    delta_records = delta_counts[checkpoint_key]
+    if int(delta_records) > settings.stream_threshold:
+        parameters = set_parameters_by_record_type(record_type, "modifieddate", last_call_date, "$gte", activity_type)
+        partitions = stream_records_to_store(record_type, delta_records, parameters, checkpoint, checkpoint_key)
     else:
-        csv_file = settings.activities_csv
-    parameters = set_parameters_by_record_type(record_type, "modifieddate", last_call_date, "$gte", activity_type)
-    modified_accounts_df = pagination_loop(record_type, parameter=parameters)
-    previous_accounts_df = pd.read_csv(csv_file)
-    modified_id_list = list(modified_accounts_df['id'])
-    unmodified_accounts_df = drop_outdated_rows(
-        previous_accounts_df, 'id', modified_id_list)
-    df_list = [unmodified_accounts_df, modified_accounts_df]
-    updated_df = pd.concat(df_list)
-    updated_df.to_csv(csv_file, index=False)
+        delta_df = fetch_delta_records(last_call_date, record_type, activity_type, get_checkpoint_dir(checkpoint_key),
+                                       delta_records)
+        partitions = store_delta_records(delta_df, record_type)
+    mark_checkpoint_complete(checkpoint, checkpoint_key)
+    return partitions
 
 
-def update_accounts_df(last_call_date):
+def update_accounts_df(last_call_date, checkpoint, delta_counts):
     """
     Updates all account data from RSS.
     :param last_call_date: Date of last recorded API call.
-    :return:
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :param delta_counts: Dictionary of scheduled checkpoint keys and their delta record counts.
+    :return: Partitions of the local store that received new records.
     """
-    created_records = check_created_records(last_call_date,
-                                            settings.accounts_url)
-    if int(created_records) > 0:
-        update_created_records(settings.accounts_url, last_call_date)
-    modified_records = check_modified_records(
-        last_call_date, settings.accounts_url)
-    print(modified_records)
-    if int(modified_records) > 0:
-        update_modified_records(settings.accounts_url, last_call_date)
+    return sync_record_type(last_call_date, checkpoint, delta_counts, settings.accounts_url)
 
 
-def update_activities_df(last_call_date):
+def update_activities_df(last_call_date, checkpoint, delta_counts, parallel=False):
     """
     Update all records for all activities.
     :param last_call_date: Date of last recorded API call
-    :return:
+    :param checkpoint: Dictionary of the sync checkpoint.
+    :param delta_counts: Dictionary of scheduled checkpoint keys and their delta record counts.
+    :param parallel: Fetch every activity type at once. Default=False
+    :return: Partitions of the local store that received new records.
     """
-    for i in settings.activity_types:
-        print(f"\nChecking {i} Records:")
-        created_records = check_created_records(
-            last_call_date, settings.activities_url, i)
-        if int(created_records) > 0:
-            update_created_records(settings.activities_url, last_call_date, activity_type=i)
-        modified_records = check_modified_records(
-            last_call_date, settings.activities_url, i)
-        if int(modified_records) > 0:
-            update_modified_records(
-                settings.activities_url, last_call_date, activity_type=i)
+    if parallel:
+        with ThreadPoolExecutor(max_workers=settings.max_parallel_activity_types) as executor:
+            partitions = list(executor.map(
+                lambda i: sync_record_type(last_call_date, checkpoint, delta_counts, settings.activities_url, i),
+                settings.activity_types))
+    else:
+        partitions = [sync_record_type(last_call_date, checkpoint, delta_counts, settings.activities_url, i)
+                      for i in settings.activity_types]
+    return [path for i in partitions for path in i]
 
 
-def update_last_call_date():
+def update_last_call_date(last_call_date=None):
     """
     Update the last call date in api_call_history.json
+    :param last_call_date: Date to record. Default=None records the current time.
     :return:
     """
-    with open(settings.call_history) as f:
-        decoded = json.load(f)
-    decoded['Last Call Date'] = str(dt.now())
-    with open(settings.call_history, 'w') as f:
-        json.dump(decoded, f)
+    decoded = read_call_history()
+    decoded['Last Call Date'] = str(dt.now()) if last_call_date is None else last_call_date
+    write_call_history(decoded)
     print(f"Last Call Date Updated: {decoded['Last Call Date']}")
 
 
-def collect_data():
+def collect_data(parallel=False):
     """
     Updates all accounts and activities since the last call date before updating the last call date.
+    :param parallel: Sync all activity types at once. Default=False
     :return:
     """
+    lsm.seed_store(settings.accounts_url)
+    lsm.seed_store(settings.activities_url)
     last_call_date = get_last_call_date()
+    checkpoint = start_sync_checkpoint(last_call_date)
+    delta_counts, deferred = plan_sync(last_call_date, checkpoint)
     while True:
         try:
-            update_accounts_df(last_call_date)
-            update_activities_df(last_call_date)
+            update_accounts_df(last_call_date, checkpoint, delta_counts)
+            update_activities_df(last_call_date, checkpoint, delta_counts, parallel=parallel)
+            # Compact every partition with segments, including those appended before an interruption.
+            lsm.refresh_record_caches()
             break
         except PermissionError:
             run = input("Unable to access file, please close any open files related to reported and enter: 'run' ")
             if input == 'run':
                 continue
-    update_last_call_date()
+    if len(deferred) > 0:
+        print("Last Call Date Not Updated: Deferred records will be synced once the API budget allows.")
+        return
+    # Records modified while an interrupted sync was paused are picked up by the next sync.
+    update_last_call_date(checkpoint['Sync Started'])
+    clear_sync_checkpoint()
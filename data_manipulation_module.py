@@ -1,24 +1,116 @@
+import re
 import numpy as np
 import pandas as pd
+import local_store_module as lsm
+import pipeline_module as pm
+import fiscal_calendar_module as fcm
 from settings_RSS import Settings
 
 settings = Settings()
 
 pd.set_option('mode.chained_assignment', None)
 
+REPORTING_FACTS = 'reporting_facts'
+REPORTING_DF = 'reporting_df'
 
-def get_accounts_activities_dataframes(accounts_path, activities_path):
+
+def get_as_of(as_of=None):
+    """
+    Identify the timestamp that time relative columns are calculated from.
+    :param as_of: Timestamp or date string. Default=None uses settings.now
+    :return: Timestamp
     """
-    Produces dataframes from the accounts and activities csv files.
-    :param accounts_path: Path to accounts.csv
-    :param activities_path: Path to activities.csv
+    return settings.now if as_of is None else pd.Timestamp(as_of)
+
+
+def get_accounts_activities_dataframes():
+    """
+    Produces typed dataframes from the cached copy of the local store.
     :return: accounts and activities dataframes
     """
-    accounts_df = pd.read_csv(accounts_path)
-    activities_df = pd.read_csv(activities_path)
+    accounts_df = lsm.read_cached_records(settings.accounts_url)
+    activities_df = lsm.read_cached_records(settings.activities_url)
     return accounts_df, activities_df
 
 
+def build_activity_index(activities_df):
+    """
+    Partition activities by type a single time, with each partition sorted by accountid and date.
+    :param activities_df: activities_df
+    :return: Dictionary of activity type and the dataframe of that type's activities.
+    """
+    df = activities_df.sort_values(['accountid', 'date'], kind='mergesort')
+    empty_df = df.iloc[0:0]
+    activity_index = {i: empty_df for i in settings.activity_types}
+    activity_index.update({k: v for k, v in df.groupby('type', sort=False, observed=True)})
+    return activity_index
+
+
+def select_activities(activity_index, *activity_types):
+    """
+    Select the activities of one or more types from the activity index.
+    :param activity_index: Dictionary of activity type and the dataframe of that type's activities.
+    :param activity_types: Types of activities to select.
+    :return: Copy of the selected activities, sorted by accountid and date.
+    """
+    empty_df = next(iter(activity_index.values())).iloc[0:0]
+    frames = [activity_index.get(i, empty_df) for i in activity_types]
+    if len(frames) == 1:
+        return frames[0].copy()
+    return pd.concat(frames).sort_values(['accountid', 'date'], kind='mergesort')
+
+
+def reduce_to_one_per_account(df, column, grouping='max', dropna=True):
+    """
+    Keep a single row per account, the row with the latest (max) or earliest (min) value in a column, using one stable
+    sort and take. Ties are broken by the most recently modified activity, then by the highest activity id.
+    :param df: Dataframe of activities.
+    :param column: Column used to choose each account's row.
+    :param grouping: min or max. Default='max'
+    :param dropna: Exclude rows where the column is empty. Default=True
+    :return: Dataframe with one row per accountid.
+    """
+    if dropna:
+        df = df.dropna(subset=[column])
+    tie_breakers = [i for i in ['modifieddate', 'id'] if i in df.columns and i != column]
+    sort_columns = ['accountid', column] + tie_breakers
+    ascending = [True, grouping == 'max'] + [True] * len(tie_breakers)
+    df = df.sort_values(sort_columns, ascending=ascending, kind='mergesort', na_position='first')
+    return df.drop_duplicates(subset=['accountid'], keep='last')
+
+
+def is_flagged(series):
+    """
+    Read a flag column as plain booleans, treating missing values as not flagged.
+    :param series: bool or nullable boolean column.
+    :return: Boolean series.
+    """
+    return series.fillna(False).astype(bool)
+
+
+def as_feature_frame(df):
+    """
+    Index a feature frame by accountid, storing flags as nullable booleans so accounts without the feature stay empty
+    once the frame is joined.
+    :param df: Dataframe of per-account features.
+    :return: Dataframe indexed by accountid.
+    """
+    df = df.set_index('accountid')
+    flag_columns = [i for i in df.columns if pd.api.types.is_bool_dtype(df[i])]
+    df[flag_columns] = df[flag_columns].astype('boolean')
+    return df
+
+
+def join_feature_frames(reporting_df, feature_frames):
+    """
+    Join the per-account feature frames produced by the apply_* stages onto the reporting df in a single aligned join.
+    :param reporting_df: reporting_df
+    :param feature_frames: List of dataframes indexed by accountid.
+    :return: reporting_df featuring the columns of every feature frame.
+    """
+    return reporting_df.set_index('accountid').join(feature_frames, how='left').reset_index()
+
+
 def initiate_reporting_df(accounts_df):
     """
     Create the reporting dataframe using accounts.csv as the source.
@@ -28,38 +120,51 @@ def initiate_reporting_df(accounts_df):
     return accounts_df.rename(columns={'id': 'accountid'})
 
 
-def incorporate_returning_client_df(df, activities_df):
+def format_returning_client_df(activity_index):
     """
-    Prepare returning client.csv data to be merged into reporting_df.
-    :param df: reporting_df created from accounts.csv
-    :param activities_df: dataframe created from activities.csv
-    :return: reporting_df with returning client activities merged.
+    Prepare returning client.csv data to be joined into reporting_df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring each client's most recent return, or None if there are none.
     """
-    returning_client_df = activities_df[activities_df['type'] == 'Returning Client'].rename(
+    returning_client_df = select_activities(activity_index, 'Returning Client').rename(
         columns={'date': 'returning_date', 'trainingprogram': 'returning_training_program'})
-    returning_client_df = returning_client_df[returning_client_df['returning_date'] == returning_client_df.groupby(
-        'accountid').returning_date.transform('max')]
+    returning_client_df = reduce_to_one_per_account(returning_client_df, 'returning_date')
     if returning_client_df.empty:
         print("No Returning Client Data to Manipulate")
-    else:
-        returning_client_df['returning_client'] = "Yes"
-        cols = ['accountid', 'returning_date', 'returning_training_program', 'returning_client']
-        returning_client_df = returning_client_df.reindex(cols, axis='columns')
-        df = pd.merge(df, returning_client_df, how='left',
-                      on='accountid')
-        df = df.drop_duplicates(subset=['accountid'])
-    return df
+        return None
+    returning_client_df['returning_client'] = True
+    cols = ['accountid', 'returning_date', 'returning_training_program', 'returning_client']
+    return as_feature_frame(returning_client_df.reindex(cols, axis='columns'))
 
 
-def coerce_to_datetime(df, *column_names):
+def coerce_to_datetime(df, *column_names, date_format=None):
     """
-    Coerce date related columns to datetime format.
+    Coerce date related columns to datetime format. Columns that are already datetimes are left as they are.
     :param df: Dataframe containing columns that need to be converted to datetime.
     :param column_names: Columns that need to be converted to datetime.
+    :param date_format: Format of the dates. Default=None uses settings.rss_date_format
     :return: Dataframe with appropriate datetime formatted columns.
     """
     for i in column_names:
-        df[i] = pd.to_datetime(df[i].dropna(), errors='coerce').copy()
+        df[i] = lsm.parse_dates(df[i], date_format)
+    return df
+
+
+def coerce_to_numeric(df, *column_names):
+    """
+    Coerce columns to numbers one column at a time, reporting how many values in each column couldn't be converted.
+    :param df: Dataframe containing columns that need to be converted to numbers.
+    :param column_names: Columns that need to be converted to numbers.
+    :return: Dataframe with numeric columns.
+    """
+    for i in column_names:
+        if pd.api.types.is_numeric_dtype(df[i]):
+            continue
+        numeric = pd.to_numeric(df[i], errors='coerce')
+        errors = (numeric.isnull() & df[i].notnull() & (df[i].astype(str).str.strip() != '')).sum()
+        if errors > 0:
+            print(f"{errors} {i} values could not be converted to numbers.")
+        df[i] = numeric
     return df
 
 
@@ -70,9 +175,9 @@ def identify_current_intake_program(df):
     :return: Dataframe featuring columns that identify most recent client intake dates.
     """
     try:
-        df['originalintakedate'] = np.where(df['returning_client'] != "Yes", df['originalintakedate'],
+        df['originalintakedate'] = np.where(~is_flagged(df['returning_client']), df['originalintakedate'],
                                              df['returning_date'])
-        df['originaltrainingprogram'] = np.where(df['returning_client'] != "Yes", df['originaltrainingprogram'],
+        df['originaltrainingprogram'] = np.where(~is_flagged(df['returning_client']), df['originaltrainingprogram'],
                                          df['returning_training_program'])
     except:
         print("No Returning Client Data To Manipulate")
@@ -96,55 +201,41 @@ def assign_job_coach_initials(df):
     coach_initials = ['CH', 'RV', 'SH', 'KD', 'RG', 'ML', 'VOID', 'MND', 'ST', 'MR', 'KH', 'MD', 'JE', 'JB', 'AH',
                       'SBT', 'JC', 'DH', 'MG', 'RSS Support', 'RB', 'MM', 'MS', 'VF'] #todo create job coach id dictionary
 
-    df['case_manager'] = np.select(owner_ids, coach_initials, default=np.nan)
+    df['case_manager'] = pd.Categorical(np.select(owner_ids, coach_initials, default=np.nan))
     return df
 
 
+def get_enrollment_date(df):
+    """
+    Identify the date each client's enrollment counts from. Satisfied CTC, MTDL and CF enrollments count from the
+    cohort date, every other enrollment from the original intake date.
+    :param df: reporting_df
+    :return: Datetime series of enrollment dates.
+    """
+    coerce_to_datetime(df, 'originalintakedate', 'cohort_date')
+    cohort_enrollment = df['enrollment_satisfied'] & df['originaltrainingprogram'].str.contains('CTC|MTDL|CF', na=False)
+    return df['cohort_date'].where(cohort_enrollment, df['originalintakedate'])
+
+
 def assign_fiscal_quarter(df):
     """
     Create a column that identifies the fiscal year quarter of each client.
     :param df: reporting_df
     :return: Dataframe tht includes the fiscal quarter of each clients most recent intake.
     """
-    coerce_to_datetime(df,'originalintakedate','cohort_date')
-    df['month'] = np.where(
-        ((df['enrollment_satisfied'] == 'Yes') & df['originaltrainingprogram'].str.contains('CTC|MTDL|CF')),
-        pd.DatetimeIndex(df['cohort_date']).month,
-        pd.DatetimeIndex(df['originalintakedate']).month)
-
-    q_conditions = [
-        (df['month'] <= 3.0),
-        ((df['month'] > 3.0) & (df['month'] < 7.0)),
-        ((df['month'] > 6.0) & (df['month'] < 10.0)),
-        (df['month'] >= 10.0)
-    ]
-
-    q_values = ['Quarter 3', 'Quarter 4', 'Quarter 1', 'Quarter 2']
-
-    df['quarter'] = np.select(q_conditions, q_values, default=np.nan)
+    enrollment_date = get_enrollment_date(df)
+    df['month'] = enrollment_date.dt.month
+    df['quarter'] = fcm.fiscal_quarter(enrollment_date)
     return df
 
 def assign_intake_quarter(df):
-    coerce_to_datetime(df, 'originalintakedate', 'cohort_date')
-    df['intake_month'] = pd.DatetimeIndex(df['originalintakedate']).month
-
-    q_conditions = [
-        (df['intake_month'] <= 3.0),
-        ((df['intake_month'] > 3.0) & (df['intake_month'] < 7.0)),
-        ((df['intake_month'] > 6.0) & (df['intake_month'] < 10.0)),
-        (df['intake_month'] >= 10.0)
-    ]
-
-    q_values = ['Quarter 3', 'Quarter 4', 'Quarter 1', 'Quarter 2']
-
-    df['intake_quarter'] = np.select(q_conditions, q_values, default=np.nan)
+    coerce_to_datetime(df, 'originalintakedate')
+    df['intake_month'] = df['originalintakedate'].dt.month
+    df['intake_quarter'] = fcm.fiscal_quarter(df['originalintakedate'])
     return df
 
 def assign_intake_fy(df):
-    df['intake_fy'] = pd.DatetimeIndex(df['originalintakedate']).year
-    df['intake_fy'] = np.where((df['intake_month'] > 6.0), (df['intake_fy'] + 1.0), df['intake_fy'])
-    df['intake_fy'] = df['intake_fy'].fillna(0.0).astype(int)
-
+    df['intake_fy'] = fcm.fiscal_year(df['originalintakedate'])
     return df
 
 
@@ -154,24 +245,22 @@ def assign_fiscal_year(df):
     :param df: reporting_df
     :return: Dataframe where the fiscal year of the client's intake date is calculated.
     """
-    df['year'] = np.where(
-        ((df['enrollment_satisfied'] == 'Yes') & df['originaltrainingprogram'].str.contains('CTC|MTDL|CF')),
-        pd.DatetimeIndex(df['cohort_date']).year,
-        pd.DatetimeIndex(df['originalintakedate']).year)
-    df['fiscal_year'] = np.where((df['month'] > 6.0), (df['year'] + 1.0), df['year'])
-    df['fiscal_year'] = df['fiscal_year'].fillna(0.0).astype(int)
-
+    enrollment_date = get_enrollment_date(df)
+    df['year'] = enrollment_date.dt.year
+    df['fiscal_year'] = fcm.fiscal_year(enrollment_date)
     return df
 
 
-def apply_returning_client_data(df, activities_df):
+def apply_returning_client_data(df, activity_index):
     """
     Manipulate and apply returning client data to the aggregated reporting df.
     :param df: reporting_df
-    :param activities_df: Dataframe created from activities.csv
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe that includes columns related to returning clients, fiscal year, and fiscal quarter.
     """
-    df = incorporate_returning_client_df(df, activities_df)
+    returning_client_df = format_returning_client_df(activity_index)
+    if returning_client_df is not None:
+        df = join_feature_frames(df, [returning_client_df])
     df = identify_current_intake_program(df)
     df = coerce_to_datetime(df, 'originalintakedate', 'returning_date', 'dob', 'originalintakedate')
     df = assign_job_coach_initials(df)
@@ -181,25 +270,39 @@ def apply_returning_client_data(df, activities_df):
     return df
 
 
+def multi_hot(series, labels):
+    """
+    Mark which labels appear in each value of a multi-valued text column, scanning the text a single time.
+    :param series: Column of text that holds any number of labels.
+    :param labels: Labels to look for.
+    :return: Boolean dataframe aligned with the series, featuring a column for each label.
+    """
+    # Longer labels are tried first so a label is never matched by one of its prefixes.
+    pattern = '|'.join(re.escape(i) for i in sorted(labels, key=len, reverse=True))
+    matches = series.reset_index(drop=True).str.extractall(f"({pattern})")[0]
+    matrix = pd.get_dummies(matches).groupby(level=0).any()
+    matrix = matrix.reindex(index=range(len(series)), columns=labels, fill_value=False).astype(bool)
+    matrix.index = series.index
+    return matrix
+
+
 def parse_placement_retention(df):
     """
     Parse data from the placementretention column and create columns to represent each individual detail.
     :param df: Dataframe of employment records in activities.csv
     :return: Dataframe of employment details featuring a column for each item in settings.employment_details.
     """
-    for i in settings.employment_details:
-        df.loc[:, f'{i}'] = np.where(df['placementretention'].str.contains(f'{i}'), "Yes", "No")
-
+    df[settings.employment_details] = multi_hot(df['placementretention'], settings.employment_details)
     return df
 
 
-def format_client_became_employed_df(activities_df):
+def format_client_became_employed_df(activity_index):
     """
     Properly format employment data to be introduced to the reporting df.
-    :param activities_df: Dataframe created from activities.csv
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe made up of entirely employment records.
     """
-    employment_df = activities_df[activities_df['type'] == 'Client Became Employed']
+    employment_df = select_activities(activity_index, 'Client Became Employed')
     employment_df.loc[:, 'placement_type'] = np.where(
         employment_df['placementretention'].str.contains('Initial Placement'), 'Initial Placement',
         'Secondary Placement')
@@ -219,120 +322,103 @@ def rename_columns(prefix, df):
     return df
 
 
-def incorporate_tiered_placement_data(employment_df, reporting_df, grouping, prefix):
+def format_tiered_placement_df(employment_df, grouping, prefix):
     """
-    Format a dataframe of Initial Placement data and merge it into the aggregated reporting df
+    Format a dataframe of Initial or Current Placement data to be joined into the aggregated reporting df
     :param employment_df: employment_df
-    :param reporting_df: reporting_df
     :param grouping: min or max
     :param prefix: initial or current placement
-    :return: Updated reporting_df that features initial and current employment details for each client.
+    :return: Dataframe indexed by accountid that features initial or current employment details for each client.
     """
     df = coerce_to_datetime(employment_df, 'startdate')
-    df = df[df['startdate'] == df.groupby('accountid').startdate.transform(grouping)]
+    df = reduce_to_one_per_account(df, 'startdate', grouping)
     df = df[['accountid', 'startdate', 'placement_type', 'employer', 'position', 'wage', 'hours', 'Full Time',
              'Benefits', 'Temporary', 'MND Lead', 'Industry Related']]
     rename_columns(prefix, df)
-    reporting_df = pd.merge(reporting_df, df, how='left', on='accountid')
-    reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
-    return reporting_df
+    return as_feature_frame(df)
 
 
-def incorporate_job_hopping_data(employment_df, reporting_df):
+def format_job_hopping_df(employment_df):
     """
-    Format a dataframe of Job Hopping data and merge it into the aggregated reporting df.
+    Format a dataframe of Job Hopping data to be joined into the aggregated reporting df.
     :param employment_df: employment_df
-    :param reporting_df: reporting_df
-    :return: Modified reporting_df featuring columns identifier job hoppers and their most recent job hop.
+    :return: Dataframe indexed by accountid featuring columns identifying job hoppers and their most recent job hop.
     """
     df = coerce_to_datetime(employment_df, 'startdate')
-    df = df[df['Job Hopping'] == 'Yes']
-    df = df[df['startdate'] == df.groupby('accountid').startdate.transform('max')].rename(
-        columns={'startdate': 'last_job_hop'})
+    df = df[df['Job Hopping']]
+    df = reduce_to_one_per_account(df, 'startdate').rename(columns={'startdate': 'last_job_hop'})
     df = df[['accountid', 'Job Hopping', 'last_job_hop']]
-    reporting_df = pd.merge(reporting_df, df, how='left', on='accountid')
-    reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
-    return reporting_df
+    return as_feature_frame(df)
 
 
-def apply_employment_data(df, activities_df):
+def apply_employment_data(activity_index):
     """
-    Manipulate and apply client became employed data to the aggregated reporting df.
-    :param df: reporting_df
-    :param activities_df: Dataframe created from accounts.csv
-    :return: Modified reporting_df featuring columns for all relevant employment data
+    Manipulate client became employed data for the aggregated reporting df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring columns for all relevant employment data
     """
-    employment_df = format_client_became_employed_df(activities_df)
-    df = incorporate_tiered_placement_data(employment_df, df, 'min', 'initial_')
-    df = incorporate_tiered_placement_data(employment_df, df, 'max', 'current_')
-    df = incorporate_job_hopping_data(employment_df, df)
+    employment_df = format_client_became_employed_df(activity_index)
+    df = pd.concat([format_tiered_placement_df(employment_df, 'min', 'initial_'),
+                    format_tiered_placement_df(employment_df, 'max', 'current_'),
+                    format_job_hopping_df(employment_df)], axis=1)
     df = coerce_to_datetime(df, 'last_job_hop', 'current_startdate', 'initial_startdate')
 
     return df
 
 
-def format_retention_df(activities_df):
+def format_retention_df(activity_index):
     """
     Properly format retention data to be integrated to the reporting df.
-    :param activities_df: Dataframe created from activities.csv
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe made up exclusively of retention records.
     """
-    df = activities_df[activities_df['type'] == 'Retention']
-    df.loc[:, 'advancement'] = np.where(df['placementretention'].str.contains('Retention and Advancement'), 'Yes', 'No')
-    df['retained'] = np.where(df['placementretention'].str.contains('Job Retained'), 'Yes', 'No')
+    df = select_activities(activity_index, 'Retention')
+    df.loc[:, 'advancement'] = df['placementretention'].str.contains('Retention and Advancement', na=False)
+    df['retained'] = df['placementretention'].str.contains('Job Retained', na=False)
     return df
 
 
-def incorporate_advancements(retention_df, reporting_df):
+def format_advancement_df(retention_df):
     """
-    Properly format and incorporate career advancements.
+    Properly format career advancements.
     :param retention_df: retention_df
-    :param reporting_df: reporting_df
-    :return: Modified reporting_df featuring column identifying clients that achieved career advancement.
+    :return: Dataframe indexed by accountid featuring column identifying clients that achieved career advancement.
     """
-    advanced_df = retention_df[
-        retention_df['advancement'] == 'Yes']
-    reporting_df = pd.merge(reporting_df, advanced_df[['accountid', 'advancement']], how='left', on='accountid')
-    reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
-    return reporting_df
+    advanced_df = reduce_to_one_per_account(retention_df[retention_df['advancement']], 'date', dropna=False)
+    return as_feature_frame(advanced_df[['accountid', 'advancement']])
 
 
-def incorporate_last_retention_data(retention_df, reporting_df):
+def format_last_retention_df(retention_df):
     """
     Create a dataframe made up of only the most recent retention updates per account.
     :param retention_df: retention_df
-    :param reporting_df: reporting_df
-    :return: Modified reporting_df featuring status and date of most recent retention update.
+    :return: Dataframe indexed by accountid featuring status and date of most recent retention update.
     """
     df = coerce_to_datetime(retention_df, 'date')
-    df = df[df['date'] == df.groupby('accountid').date.transform('max')].rename(
+    df = reduce_to_one_per_account(df, 'date').rename(
         columns={'date': 'last_retention_update', 'placementretention': 'last_retention_status'})
     df = df[['accountid', 'last_retention_update', 'last_retention_status']]
-    reporting_df = pd.merge(reporting_df, df, how='left', on='accountid')
-    reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
-    return reporting_df
+    return as_feature_frame(df)
 
 
-def incorporate_last_date_retained(retention_df, reporting_df):
+def format_last_date_retained_df(retention_df):
     """
-    Identify the last date a job was retained and include column in aggregated reporting df.
+    Identify the last date a job was retained for the aggregated reporting df.
     :param retention_df: retention_df
-    :param reporting_df: reporting_df
-    :return: Modified reporting_df the features column identifying the last date where client retained job.
+    :return: Dataframe indexed by accountid featuring column identifying the last date where client retained job.
     """
     df = coerce_to_datetime(retention_df, 'date')
-    df = df[(df['retained'] == 'Yes')]
-    df = df[df['date'] == df.groupby('accountid').date.transform('max')].rename(columns={'date': 'last_date_retained'})
+    df = df[df['retained']]
+    df = reduce_to_one_per_account(df, 'date').rename(columns={'date': 'last_date_retained'})
     df = df[['accountid', 'last_date_retained']]
-    reporting_df = pd.merge(reporting_df, df, how='left', on='accountid')
-    reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
-    return reporting_df
+    return as_feature_frame(df)
 
 
-def identify_milestones(df):
+def identify_milestones(df, as_of=None):
     """
     Calculate each client's retention/employment milestones.
     :param df: reporting_df
+    :param as_of: Timestamp the call due column is calculated from. Default=None uses settings.now
     :return: Modified reporting_df featuring columns identifying retention and employment milestones.
     """
     coerce_to_datetime(df,'last_date_retained', 'last_job_hop', 'initial_startdate','originalintakedate',
@@ -342,74 +428,80 @@ def identify_milestones(df):
     retained_since_intake = (df['last_date_retained'] - df['originalintakedate'])
     update_since_intake = (df['last_retention_update'] - df['originalintakedate'])
     update_since_startdate = (df['last_retention_update'] - df['initial_startdate'])
-    time_since_startdate = settings.now - df['initial_startdate']
 
-    df['incumbent_worker'] = np.where(((df['howlongjobless'] == 'Currently employed') |
-                                       (df['howlongjobless'] == 'Still Working')), 'Yes', 'No')
+    df['incumbent_worker'] = (df['howlongjobless'] == 'Currently employed') | (df['howlongjobless'] == 'Still Working')
     df['nonincumbent_retention_milestone'] = np.where((df['last_job_hop'].isnull()) |
                                                       (retention_since_job_hop <= settings.zero_days),
                                                       retained_since_startdate.dt.days, retention_since_job_hop.dt.days)
-    df['incumbent_retention_milestone'] = np.where((df['incumbent_worker'] == "Yes") & (df['last_job_hop'].isnull()) |
+    df['incumbent_retention_milestone'] = np.where(df['incumbent_worker'] & (df['last_job_hop'].isnull()) |
                                                    (retention_since_job_hop <= settings.zero_days),
                                                    retained_since_intake.dt.days, retention_since_job_hop.dt.days)
-    df['retention_milestone'] = np.where(df['incumbent_worker'] == 'Yes', df['incumbent_retention_milestone'],
+    df['retention_milestone'] = np.where(df['incumbent_worker'], df['incumbent_retention_milestone'],
                                          df['nonincumbent_retention_milestone'])
-    df['employment_milestone'] = np.where(df['incumbent_worker'] == 'Yes', retained_since_intake.dt.days,
+    df['employment_milestone'] = np.where(df['incumbent_worker'], retained_since_intake.dt.days,
                                           retained_since_startdate.dt.days)
-    df['contact_milestone'] = np.where(df['incumbent_worker'] == 'Yes', update_since_intake.dt.days,
+    df['contact_milestone'] = np.where(df['incumbent_worker'], update_since_intake.dt.days,
                                        update_since_startdate.dt.days)
-    df['call due'] = np.where(
+    df = identify_call_due(df, as_of)
+    return df
+
+
+def identify_call_due(df, as_of=None):
+    """
+    Identify clients that are due a retention call. Inactive clients are never due a call.
+    :param df: reporting_df
+    :param as_of: Timestamp the call due column is calculated from. Default=None uses settings.now
+    :return: Modified reporting_df featuring the call due column.
+    """
+    update_since_startdate = (df['last_retention_update'] - df['initial_startdate'])
+    time_since_startdate = get_as_of(as_of) - df['initial_startdate']
+    call_due = (
         (df['initial_placement_type'].notnull() & df['last_retention_status'].isnull()) |
         ((time_since_startdate > settings.thirty_days) & (update_since_startdate < settings.thirty_days)) |
         ((time_since_startdate > settings.ninety_days) & (update_since_startdate < settings.ninety_days)) |
         ((time_since_startdate > settings.one_eighty_days) & (update_since_startdate < settings.one_eighty_days)) |
         ((time_since_startdate > settings.one_year) & (update_since_startdate < settings.one_year)) |
-        ((time_since_startdate > settings.two_year) & (update_since_startdate < settings.two_year)), "Yes", "No")
+        ((time_since_startdate > settings.two_year) & (update_since_startdate < settings.two_year)))
+    df['call due'] = call_due & ~is_flagged(df['inactive'])
     return df
 
 
-def apply_retention_data(df, activities_df):
+def apply_retention_data(activity_index):
     """
-    Manipulate and apply retention data to the aggregated reporting df.
-    :param df: reporting_df
-    :param activities_df: Dataframe created from activities.csv
-    :return: Modified reporting_df that features all relevant retention information.
+    Manipulate retention data for the aggregated reporting df. Milestones are identified once the features are joined.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid that features all relevant retention information.
     """
-    retention_df = format_retention_df(activities_df)
-    df = incorporate_advancements(retention_df, df)
-    df = incorporate_last_retention_data(retention_df, df)
-    df = incorporate_last_date_retained(retention_df, df)
+    retention_df = format_retention_df(activity_index)
+    df = pd.concat([format_advancement_df(retention_df),
+                    format_last_retention_df(retention_df),
+                    format_last_date_retained_df(retention_df)], axis=1)
     df = coerce_to_datetime(df, 'last_date_retained', 'last_retention_update', )
-    df = identify_milestones(df)
 
     return df
 
 
-def format_cohort_df(activities_df):
+def format_cohort_df(activity_index):
     """
     Properly format cohort data to be incorporated into the reporting df.
-    :param activities_df: activities_df
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe made up of Cohort records.
     """
-    df = activities_df.rename(columns={'startdate': 'cohort_date'})
-    df = df[df['type'] == 'Cohort']
+    df = select_activities(activity_index, 'Cohort').rename(columns={'startdate': 'cohort_date'})
     coerce_to_datetime(df, 'date')
-    df = df[df['date'] == df.groupby('accountid').date.transform('max')]
+    df = reduce_to_one_per_account(df, 'date')
     df = df[['accountid', 'cohort_date']].copy()
     return df
 
 
-def apply_cohort_data(df, activities_df):
+def apply_cohort_data(activity_index):
     """
-    Manipulate and apply cohort data to the aggregated reporting df.
-    :param df: reporting_df
-    :param activities_df: activities_df
-    :return: Modified reporting_df featuring Cohort data
+    Manipulate cohort data for the aggregated reporting df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring Cohort data
     """
-    cohort_df = format_cohort_df(activities_df)
-    df = pd.merge(df, cohort_df, how='left', on='accountid')
+    df = as_feature_frame(format_cohort_df(activity_index))
     df = coerce_to_datetime(df, 'cohort_date')
-    df = df.drop_duplicates(subset='accountid')
     return df
 
 
@@ -419,214 +511,208 @@ def format_certification_df(df):
     :param df: activities_df
     :return: Dataframe containing certification status and accountid.
     """
-    df.loc[:, 'gained_certification'] = 'Yes'
-    df = df.drop_duplicates(subset=['accountid']).copy()
-    df = df[['accountid', 'gained_certification']].copy()
+    df = reduce_to_one_per_account(df, 'date', dropna=False)
+    # assign keeps working when the account has no certifications, setting a scalar with .loc doesn't.
+    df = df.assign(gained_certification=True)
+    df = as_feature_frame(df[['accountid', 'gained_certification']])
     return df
 
 
-def create_certification_columns(df, reporting_df):
+def create_certification_columns(df):
     """
     Create a column for each certification type, indicating if the client has gained said type.
     :param df: certification_df
-    :param reporting_df: reporting_df
-    :return: Modified reporting_df featuring columns of date and type for each type of certification.
+    :return: Dataframe indexed by accountid featuring columns of date and type for each type of certification.
     """
     certification_df = df.dropna(subset=['certification'])
-    for i in settings.certification_types:
-        certification_df[f"{i}"] = np.where(certification_df['certification'].str.contains(f"{i}"), 'Yes', 'No')
-        df = certification_df[certification_df[f"{i}"] == 'Yes'].rename(columns={'date': f"{i}_date"})
-        df = coerce_to_datetime(df, f"{i}_date")
-        df = df[['accountid', f"{i}", f"{i}_date"]]
-        reporting_df = pd.merge(reporting_df, df, how='left', on='accountid')
-        reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
-    return reporting_df
+    labels = settings.certification_types
+    rows, types = np.nonzero(multi_hot(certification_df['certification'], labels).to_numpy())
+    # One row for every certification type each record holds.
+    held_df = pd.DataFrame({'accountid': certification_df['accountid'].to_numpy()[rows],
+                            'certification_type': np.asarray(labels)[types],
+                            'date': lsm.parse_dates(certification_df['date']).to_numpy()[rows]})
+    grouped = held_df.groupby(['accountid', 'certification_type'])['date']
+    dates = grouped.min().unstack().reindex(columns=labels)
+    held = grouped.size().unstack().reindex(columns=labels).notnull()
+    df = pd.concat([held.where(held).astype('boolean'), dates.add_suffix('_date')], axis=1)
+    df.index.name = 'accountid'
+    return df[[j for i in labels for j in (i, f"{i}_date")]]
 
 
-def apply_certification_data(reporting_df, activities_df):
+def apply_certification_data(activity_index):
     """
-    Manipulate and apply certification data to reporting df.
-    :param reporting_df: reporting_df
-    :param activities_df: activities_df
-    :return: Modified reporting_df featuring all relevant certification columns
+    Manipulate certification data for the reporting df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring all relevant certification columns
     """
-    certification_df = activities_df[activities_df['type'] == 'Certification']
-    df = create_certification_columns(certification_df, reporting_df)
-    if len(certification_df) > 0:
-        certification_df = format_certification_df(certification_df)
-        df = pd.merge(df, certification_df, how='left', on='accountid')
-    else:
-        df['gained_certification'] = "No"
-    return df
+    certification_df = select_activities(activity_index, 'Certification')
+    return pd.concat([create_certification_columns(certification_df), format_certification_df(certification_df)],
+                     axis=1)
 
 
-def format_training_status_df(activities_df):
+def format_training_status_df(activity_index):
     """
     Produce a dataframe of each client's training status.
-    :param activities_df: activities_df
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe containing the training status for each accountid.
     """
-    df = activities_df[activities_df['type'] == 'Training Status']
-    df = df[df['trainingstatus'] == "Complete"]
+    df = select_activities(activity_index, 'Training Status')
+    df = reduce_to_one_per_account(df[df['trainingstatus'] == "Complete"], 'date', dropna=False)
     df = df.rename(columns={'trainingstatus': 'training_status'})
     df = df[['accountid', 'training_status']]
     return df
 
 
-def apply_training_status_data(reporting_df, activities_df):
+def apply_training_status_data(activity_index):
     """
-    Manipulate and apply training status data to reporting df.
-    :param reporting_df: reporting_df
-    :param activities_df: activities_df
-    :return: Modified reporting_df featuring each client's training status.
+    Manipulate training status data for the reporting df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring each client's training status.
     """
-    training_status_df = format_training_status_df(activities_df)
-    df = pd.merge(reporting_df, training_status_df, how='left', on='accountid')
-    df = df.drop_duplicates(subset=['accountid'])
-    return df
+    return as_feature_frame(format_training_status_df(activity_index))
 
 
-def format_inactive_df(activities_df):
+def format_inactive_df(activity_index):
     """
     Format Inactive dataframe to be incorporated into the reporting df.
-    :param activities_df: activities_df
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe the consists of accountid's and inactive status.
     """
-    df = activities_df[(activities_df['type'] == 'Active') | (activities_df['type'] == 'Inactive')].copy()
+    df = select_activities(activity_index, 'Active', 'Inactive')
 
     coerce_to_datetime(df, 'date')
-    df = df[df['date'] == df.groupby('accountid').date.transform('max')]
+    df = reduce_to_one_per_account(df, 'date')
 
-    df.loc[:, 'inactive'] = np.where(df['type'] == "Inactive","Yes","No")
+    df.loc[:, 'inactive'] = df['type'] == "Inactive"
     df = df[['accountid', 'inactive']]
     return df
 
 
-def apply_inactive_data(reporting_df, activities_df):
+def apply_inactive_data(activity_index):
     """
-    Manipulate and apply inactive data to the reporting df.
-    :param reporting_df: reporting_df
-    :param activities_df: activities_df
-    :return: Modified reporting_df that features inactive status.
+    Manipulate inactive data for the reporting df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid that features inactive status.
     """
-    inactive_df = format_inactive_df(activities_df)
-    df = pd.merge(reporting_df, inactive_df, how='left', on='accountid')
-    df = df.drop_duplicates(subset=['accountid'])
-
-    return df
+    return as_feature_frame(format_inactive_df(activity_index))
 
 
-def format_snap_fee_confirmed_df(activities_df):
+def format_snap_fee_confirmed_df(activity_index):
     """
     Properly format SNAP FEE DF to be incorporated in reporting df.
-    :param activities_df: activities_df
+    :param activity_index: Activities partitioned by type.
     :return: Dataframe featuring columns of SNAP confirmed clients and their eligibility month.
     """
-    df = activities_df[activities_df['type'] == 'SNAP FEE Confirmed'].drop_duplicates('accountid')
+    df = select_activities(activity_index, 'SNAP FEE Confirmed')
     coerce_to_datetime(df, 'date')
-    df = df[df['date'] == df.groupby('accountid').date.transform('min')]
+    df = reduce_to_one_per_account(df, 'date', 'min')
     df['initial_confirmation'] = pd.DatetimeIndex(df['date']).strftime('%m-%Y')
     df['eligible_period'] = pd.DatetimeIndex(df['date']).month
     return df
 
 
-def apply_eligible_month_columns(snap_df, reporting_df):
+def pivot_period_columns(df, period_column, periods, prefix, marker='E'):
+    """
+    Write a column for each period a client is marked in, pivoting every period out of the accountid x period pairs
+    in one step. Used by any grant that tracks its clients per period.
+    :param df: Dataframe featuring accountid and the period column.
+    :param period_column: Column of period numbers, counted from 1.
+    :param periods: Names of the periods, in order.
+    :param prefix: Prefix of the period column names.
+    :param marker: Value written in a marked period. Default='E'
+    :return: Dataframe indexed by accountid featuring a column for each period.
+    """
+    counts = df.groupby(['accountid', period_column]).size().unstack(fill_value=0)
+    counts = counts.reindex(columns=range(1, len(periods) + 1), fill_value=0)
+    return pd.DataFrame(np.where(counts.to_numpy() > 0, marker, ''), index=counts.index,
+                        columns=[f"{prefix} {i}" for i in periods])
+
+
+def apply_eligible_month_columns(snap_df):
     """
     Write a column for each month that SNAP Client is Found Eligible.
     :param snap_df: Dataframe of SNAP eligible clients.
-    :param reporting_df: reporting_df
-    :return: Modified reporting_df that features a column for each month a client is SNAP eligible.
-    """
-    df1 = snap_df[['accountid', 'initial_confirmation' ,'eligible_period', 'type']].copy()
-    df2 = snap_df[['accountid', 'initial_confirmation','eligible_period']].drop_duplicates(subset=['accountid'])
-    for i in range(1, 13):
-        df1[f"SNAP {settings.months[i - 1]}"] = np.where(df1['eligible_period'] == i, 'E', '')
-        df3 = df1[df1[f"SNAP {settings.months[i - 1]}"] == 'E']
-        df2 = pd.merge(df2, df3[['accountid', f"SNAP {settings.months[i - 1]}"]], how='left', on='accountid')
-    df2 = df2.fillna('')
-    df2 = df2.drop_duplicates(subset=['accountid'])
-    reporting_df = pd.merge(reporting_df, df2, how='left', on='accountid')
-    return reporting_df
+    :return: Dataframe indexed by accountid that features a column for each month a client is SNAP eligible.
+    """
+    df = as_feature_frame(snap_df[['accountid', 'initial_confirmation', 'eligible_period']]
+                          .drop_duplicates(subset=['accountid']))
+    month_df = pivot_period_columns(snap_df, 'eligible_period', settings.months, 'SNAP')
+    df = df.join(month_df)
+    df[month_df.columns] = df[month_df.columns].fillna('')
+    return df
 
 
-def apply_snap_fee_data(reporting_df, activities_df):
+def apply_snap_fee_data(activity_index):
     """
-    Manipulate and Apply SNAP FEE data to reporting df.
-    :param reporting_df: reporting_df
-    :param activities_df: activities_df
-    :return: Modified reporting_df featuring all relevant SNAP data.
+    Manipulate SNAP FEE data for the reporting df.
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring all relevant SNAP data.
     """
-    snap_fee_df = format_snap_fee_confirmed_df(activities_df)
-    return apply_eligible_month_columns(snap_fee_df, reporting_df)
+    snap_fee_df = format_snap_fee_confirmed_df(activity_index)
+    return apply_eligible_month_columns(snap_fee_df)
 
-def format_earn_entry_df(activities_df):
+def format_earn_entry_df(activity_index):
     """
     Create a dataframe made up of earn entry activities
-    :param activities_df: activities_df
+    :param activity_index: Activities partitioned by type.
     :return:
     """
-    df = activities_df[activities_df['type'] == 'EARN Entry'].drop_duplicates('accountid')
+    df = select_activities(activity_index, 'EARN Entry')
     coerce_to_datetime(df, 'startdate')
-    df = df[df['startdate'] == df.groupby('accountid').startdate.transform('max')]
+    df = reduce_to_one_per_account(df, 'startdate')
     df['earn_entry'] = df['startdate']
     return df
 
-def format_earn_exit_df(activities_df):
+def format_earn_exit_df(activity_index):
     """
     Create a dataframe made up of earn entry activities
-    :param activities_df: activities_df
+    :param activity_index: Activities partitioned by type.
     :return:
     """
-    df = activities_df[activities_df['type'] == 'EARN Exit'].drop_duplicates('accountid')
+    df = select_activities(activity_index, 'EARN Exit')
     coerce_to_datetime(df, 'startdate') #todo remove redundant function for df creation
-    df = df[df['startdate'] == df.groupby('accountid').startdate.transform('max')]
+    df = reduce_to_one_per_account(df, 'startdate')
     df['earn_exit'] = df['startdate']
     return df
 
-def apply_earn_entry_exit_data(reporting_df, activities_df):
+def apply_earn_entry_exit_data(activity_index):
     """
-    Manipulate and Apply EARN Entry/Exit data to reporting df
-    :param reporting_df: reporting_df
-    :param activities_df: activities_df
-    :return:
+    Manipulate EARN Entry/Exit data for the reporting df
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid featuring EARN entry and exit dates.
     """
-    earn_entry_df = format_earn_entry_df(activities_df)
-    earn_exit_df = format_earn_exit_df(activities_df)
-    earn_df = pd.merge(earn_entry_df[['accountid','earn_entry']], earn_exit_df[['accountid', 'earn_exit']], how='left',
-                  on='accountid')
-    return pd.merge(reporting_df, earn_df, how='left', on='accountid')
+    earn_entry_df = as_feature_frame(format_earn_entry_df(activity_index))
+    earn_exit_df = as_feature_frame(format_earn_exit_df(activity_index))
+    return earn_entry_df[['earn_entry']].join(earn_exit_df[['earn_exit']], how='left')
 
-def apply_grant_id_df(grant, reporting_df, activities_df):
+def apply_grant_id_df(grant, activity_index):
     """
     Properly format snap/earn id df to be incorporated in reporting df.
     :param grant: SNAP or EARN
-    :param reporting_df: reporting_df
-    :param activities_df: activities_df
-    :return: Modified reporting_df that features a column for SNAP/EARN ID
+    :param activity_index: Activities partitioned by type.
+    :return: Dataframe indexed by accountid that features a column for SNAP/EARN ID
     """
-    df = activities_df[activities_df['type'] == grant]
+    df = reduce_to_one_per_account(select_activities(activity_index, grant), 'date', 'min', dropna=False)
     df.loc[:, f"{grant}"] = df['description'].copy()
     df = df[['accountid', f"{grant}"]]
-    reporting_df = pd.merge(reporting_df, df, how='left', on='accountid')
-    reporting_df = reporting_df.drop_duplicates(subset=['accountid'])
 
-    return reporting_df
+    return as_feature_frame(df)
 
-def apply_dol_wage_records(reporting_df):
-    df = pd.read_excel(settings.dol_wage_record)
-    reporting_df = pd.merge(reporting_df, df, how='left', on= 'accountid')
-    return reporting_df
+def apply_dol_wage_records():
+    return pd.read_excel(settings.dol_wage_record).set_index('accountid')
 
 # noinspection PyTypeChecker
-def calculate_client_age(df):
+def calculate_client_age(df, as_of=None):
     """
     Calculate client age and convert to integer.
     :param df: reporting_df
+    :param as_of: Timestamp the age is calculated from. Default=None uses settings.now
     :return: Modified reporting_df with caluclated client age.
     """
+    as_of = get_as_of(as_of)
     coerce_to_datetime(df,'dob')
-    df['dob'] = df['dob'].where(df['dob'] < pd.Timestamp('now'), df['dob'] - np.timedelta64(100, 'Y'))
-    df['age'] = (pd.Timestamp('now') - df['dob']).astype('<m8[Y]').fillna(0.0).astype(int)
+    df['dob'] = df['dob'].where(df['dob'] < as_of, df['dob'] - np.timedelta64(100, 'Y'))
+    df['age'] = (as_of - df['dob']).astype('<m8[Y]').fillna(0.0).astype(int)
     return df
 
 
@@ -637,75 +723,128 @@ def identify_cdbg(df):
     :return:
     """
     print("Identifying CDB") #todo identify redundant actions
-    df['bc_resident'] = np.where(
-        df['addresspostcode/zip'].fillna(0).replace({'-': ''}, regex=True).astype('int64').isin(settings.bc_zips), "Yes", "No") # todo clean up this function!
+    df['bc_resident'] = df['addresspostcode/zip'].fillna(0).replace({'-': ''}, regex=True).astype('int64').isin(
+        settings.bc_zips) # todo clean up this function!
     df['CDBG'] = np.where((df['addresscity'].str.contains('altimor')) &
                           (df['incomecategory'] != '') &
                           (df['incomecategory'].notnull()) &
                           (df['race'].notnull()) &
                           (df['race'] != '') &
-                          (df['bc_resident'] == 'Yes'), "CDBG", "")
+                          df['bc_resident'], "CDBG", "")
+    return df
+
+
+def get_grant_bit(grant):
+    """
+    Identify the bit that marks membership in a grant.
+    :param grant: Grant in settings.accepted_grants
+    :return: Integer with the grant's bit set, 0 for a grant that isn't accepted so nobody belongs to it.
+    """
+    if grant not in settings.accepted_grants:
+        return 0
+    return 1 << settings.accepted_grants.index(grant)
+
+
+def get_grant_membership(grant_fund):
+    """
+    Parse the Grant Fund text a single time into a bitmask of the settings.accepted_grants each client belongs to.
+    :param grant_fund: Column of Grant Fund text.
+    :return: Integer series of grant membership bitmasks.
+    """
+    grants = multi_hot(grant_fund.astype(object), settings.accepted_grants).to_numpy()
+    return pd.Series(grants.astype('int64') @ (1 << np.arange(len(settings.accepted_grants), dtype='int64')),
+                     index=grant_fund.index)
+
+
+def has_grant(membership, grant):
+    """
+    Test which clients belong to a grant.
+    :param membership: Series of grant membership bitmasks.
+    :param grant: Grant in settings.accepted_grants
+    :return: Boolean series.
+    """
+    return (membership & get_grant_bit(grant)) != 0
+
+
+def assign_grant_membership(df):
+    """
+    Identify the grants each client belongs to, adding CDBG, SNAP and EARN to the grant fund when the client qualifies.
+    :param df: reporting_df
+    :return: Modified reporting_df featuring grant_membership and unlisted_grants bitmasks.
+    """
+    listed_grants = get_grant_membership(df['grantfund'])
+    df['grant_membership'] = (listed_grants |
+                              np.where(df['CDBG'] == 'CDBG', get_grant_bit('CDBG'), 0) |
+                              np.where(df['SNAP ID'].notnull(), get_grant_bit('SNAP'), 0) |
+                              np.where(df['EARN ID'].notnull(), get_grant_bit('EARN'), 0))
+    # Grants the client qualifies for that aren't written in their grant fund.
+    df['unlisted_grants'] = df['grant_membership'] & ~listed_grants
     return df
 
 
-def kpi_statistics(df):
+def identify_active_training(df, as_of=None):
+    """
+    Identify clients in the most recent cohort that are still within its three weeks of training.
+    :param df: reporting_df
+    :param as_of: Timestamp active training is calculated from. Default=None uses settings.now
+    :return: Modified reporting_df featuring the in_active_training column.
+    """
+    df['in_active_training'] = (
+        (df['cohort_date'] == df['cohort_date'].max()) &
+        (get_as_of(as_of) <= (lsm.parse_dates(df['cohort_date']) + pd.to_timedelta('21 days'))))
+    return df
+
+
+def kpi_statistics(df, as_of=None):
     """
     Create Columns for the KPI data points.
     :param df: reporting_df
+    :param as_of: Timestamp active training is calculated from. Default=None uses settings.now
     :return: Modified reporting_df featuring columns that track client KPI's
     """
-    df['program_completion'] = np.where(
+    inactive = is_flagged(df['inactive'])
+    df['program_completion'] = (
         (df['training_status'] == 'Complete') |
-        (df['gained_certification'] == 'Yes') |
-        df['initial_placement_type'].notnull(), 'Yes', 'No')
-    df['gained_employment'] = np.where(
-        df['initial_placement_type'].notnull(), 'Yes', 'No')
-    df['enrollment_satisfied'] = np.where(
+        is_flagged(df['gained_certification']) |
+        df['initial_placement_type'].notnull())
+    df['gained_employment'] = df['initial_placement_type'].notnull()
+    df['enrollment_satisfied'] = (
         (df['originaltrainingprogram'] == 'OOO') |
-        (df['cohort_date'].notnull()), 'Yes', 'No')
-    df['enrollment_pending'] = np.where(
-        ((df['originaltrainingprogram'].notnull()) &
-         (df['enrollment_satisfied'] != 'Yes') &
-         (df['inactive'] != 'Yes')), 'Yes', 'No')
-    df['currently_employed'] = np.where(
-        ((df['gained_employment'] == 'Yes') |
-         (df['incumbent_worker'] == 'Yes')) &
-        (df['last_retention_status'] != 'Job Not Retained'),
-        'Yes', 'No')
-    df['active'] = np.where(
-        ((df['currently_employed'] != 'Yes') | (df['incumbent_worker'] == 'Yes')) &
-        ((df['gained_employment'] != "Yes") | (df['last_retention_status'].str.contains("Job Not Retained"))) &
-        (df['inactive'] != 'Yes') &
-        (df['originaltrainingprogram'].notnull()), 'Yes', 'No')
-    df['status_unknown'] = np.where(
+        (df['cohort_date'].notnull()))
+    df['enrollment_pending'] = (
         (df['originaltrainingprogram'].notnull()) &
-        (df['inactive'] != 'Yes') &
-        (df['active'] != 'Yes') &
-        (df['currently_employed'] != 'Yes'),
-        'Yes', '')
+        ~df['enrollment_satisfied'] &
+        ~inactive)
+    df['currently_employed'] = (
+        (df['gained_employment'] | df['incumbent_worker']) &
+        (df['last_retention_status'] != 'Job Not Retained'))
+    df['active'] = (
+        (~df['currently_employed'] | df['incumbent_worker']) &
+        (~df['gained_employment'] | df['last_retention_status'].str.contains("Job Not Retained", na=False)) &
+        ~inactive &
+        (df['originaltrainingprogram'].notnull()))
+    status_unknown = (
+        (df['originaltrainingprogram'].notnull()) &
+        ~inactive &
+        ~df['active'] &
+        ~df['currently_employed'])
+    # Only clients with an unknown status are flagged, the rest are left blank.
+    df['status_unknown'] = status_unknown.astype('boolean').where(status_unknown)
     df['days_to_employment'] = (df['initial_startdate'] - df['originalintakedate']).dt.days
-    df['completed_without_employment'] = np.where((df['program_completion'] == 'Yes') &
-                                                  (df['gained_employment'] != 'Yes') &
-                                                  (df['inactive'] != 'Yes'),"Yes","No")
-    df['in_active_training'] = np.where(
-        (df['cohort_date'] == df['cohort_date'].max()) &
-        (pd.to_datetime('today') <= (pd.to_datetime(df['cohort_date'],errors='coerce') + pd.to_timedelta('21 days'))),
-        "Yes","No")
+    df['completed_without_employment'] = df['program_completion'] & ~df['gained_employment'] & ~inactive
+    df = identify_active_training(df, as_of)
 
-    df['incumbent_wage_increase'] = np.where(
-        (((df['previouswagehr'].notnull()) & (df['previouswagehr'] != '') & ((df['previouswagehr'] != ' ') &
-                                                                              (df['previouswagehr'] != 0))) &
-         (df['previouswagehr'] < df['current_wage'])) & (df['incumbent_worker'] == 'Yes'), 'Yes', 'No')
+    coerce_to_numeric(df, 'previouswagehr', 'current_wage', 'previoushoursworked', 'current_hours')
+    df['incumbent_wage_increase'] = (
+        (df['previouswagehr'] != 0) & (df['previouswagehr'] < df['current_wage']) &
+        df['incumbent_worker'])
 
-    df['incumbent_hours_increase'] = np.where(
-        (((df['previoushoursworked'].notnull()) & (df['previoushoursworked'] != '') & ((df['previoushoursworked'] != ' ') &
-                                                                             (df['previoushoursworked'] != 0))) &
-         (df['previoushoursworked'].fillna(0).astype(int) < df['current_hours'].fillna(0).astype('int64'))) &
-        (df['incumbent_worker'] == 'Yes'), 'Yes', 'No')
+    df['incumbent_hours_increase'] = (
+        (df['previoushoursworked'] != 0) &
+        (np.trunc(df['previoushoursworked']) < np.trunc(df['current_hours'])) &
+        df['incumbent_worker'])
 
-    df['unreported_placement'] = np.where(
-        ((df['gained_employment'] != "Yes") & (df['dol_confirmed'] == 'Y')), "Yes", "No"
-    )
+    df['unreported_placement'] = ~df['gained_employment'] & (df['dol_confirmed'] == 'Y')
 
     return df
 
@@ -716,28 +855,186 @@ def gained_new_employment(df):
     :param df:
     :return:
     """
-    df['Gained New Employment'] = np.where(df['current_startdate'].notnull() &
-                                           (df['originalintakedate'] <= df['current_startdate']), "Yes", "No")
+    df['Gained New Employment'] = df['current_startdate'].notnull() & (df['originalintakedate'] <= df['current_startdate'])
 
-    df['incumbent_advancement'] = np.where(((df['incumbent_wage_increase'] == 'Yes') |
-                                           (df['incumbent_hours_increase'] == 'Yes') &
-                                            (df['Gained New Employment'] == 'No')), 'Yes', 'No')
+    df['incumbent_advancement'] = (df['incumbent_wage_increase'] |
+                                   df['incumbent_hours_increase'] &
+                                   ~df['Gained New Employment'])
     return df
 
 
-def format_demographics(df):
+def format_demographics(df, as_of=None):
     """
     Format Demographic Data Appropriately.
     :param df: reporting_df
+    :param as_of: Timestamp time relative columns are calculated from. Default=None uses settings.now
     :return: Modified reporting_df that features columns of information derived from demographic data and activities.
     """
-    df = calculate_client_age(df)
+    df = calculate_client_age(df, as_of)
     # Convert numeric columns
-    df[settings.numeric_cols] = df[settings.numeric_cols].apply(pd.to_numeric, errors='coerce', axis=1)
+    df = coerce_to_numeric(df, *settings.numeric_cols)
     df = identify_cdbg(df)
-    df = kpi_statistics(df)
+    df = assign_grant_membership(df)
+    df = kpi_statistics(df, as_of)
     df = gained_new_employment(df)
-    df['call due'] = np.where(df['inactive'] == "Yes","No",df['call due'])
+    return df
+
+
+def refresh_time_relative_columns(df, as_of=None):
+    """
+    Recalculate only the columns that go stale as time passes (age, in_active_training and call due).
+    :param df: Unformatted reporting_df
+    :param as_of: Timestamp the columns are calculated from. Default=None uses settings.now
+    :return: Modified reporting_df with refreshed time relative columns.
+    """
+    df = calculate_client_age(df, as_of)
+    df = identify_active_training(df, as_of)
+    df = identify_call_due(df, as_of)
+    return df
+
+
+def activity_stage(name, function, activity_types, *args):
+    """
+    Declare an apply_* stage that reads only the activity types it needs, so it only reruns when they change.
+    :param name: Name of the stage.
+    :param function: apply_* function that takes an activity index as its last argument.
+    :param activity_types: Types of activities the stage reads.
+    :param args: Arguments passed to the function ahead of the activity index.
+    :return: Pipeline stage.
+    """
+    return pm.Stage(name, function, activity_types, args=args, grouped=True)
+
+
+def get_feature_stages():
+    """
+    Declare the apply_* stages that produce per-account feature frames.
+    :return: List of pipeline stages.
+    """
+    return [activity_stage('employment', apply_employment_data, ['Client Became Employed']),
+            activity_stage('retention', apply_retention_data, ['Retention']),
+            activity_stage('cohort', apply_cohort_data, ['Cohort']),
+            activity_stage('certification', apply_certification_data, ['Certification']),
+            activity_stage('training_status', apply_training_status_data, ['Training Status']),
+            activity_stage('inactive', apply_inactive_data, ['Active', 'Inactive']),
+            activity_stage('snap_fee', apply_snap_fee_data, ['SNAP FEE Confirmed']),
+            activity_stage('earn_entry_exit', apply_earn_entry_exit_data, ['EARN Entry', 'EARN Exit']),
+            activity_stage('snap_id', apply_grant_id_df, ['SNAP ID'], "SNAP ID"),
+            activity_stage('earn_id', apply_grant_id_df, ['EARN ID'], "EARN ID")]
+
+
+def build_reporting_base(accounts_df, *feature_frames):
+    """
+    Create reporting_df from accounts and join the feature frames of the apply_* stages.
+    :param accounts_df: accounts_df
+    :param feature_frames: Dataframes indexed by accountid.
+    :return: reporting_df featuring the account data and every apply_* stage's features.
+    """
+    reporting_df = initiate_reporting_df(accounts_df)
+    #reporting_df = apply_returning_client_data(reporting_df, activity_index)
+    reporting_df = assign_job_coach_initials(reporting_df)
+    return join_feature_frames(reporting_df, list(feature_frames))
+
+
+def apply_milestones(df, dol_wage_records_df, as_of):
+    """
+    Join DOL wage records to the per-account facts and identify milestones.
+    :param df: reporting_df
+    :param dol_wage_records_df: Dataframe of DOL wage records indexed by accountid.
+    :param as_of: Timestamp the call due column is calculated from.
+    :return: Modified reporting_df featuring wage records and milestones.
+    """
+    df = join_feature_frames(df, [dol_wage_records_df])
+    columns = list(df.columns)
+    df = identify_milestones(df, as_of)
+    # The milestone columns are exported right after the retention columns, where the report templates expect them.
+    milestones = [i for i in df.columns if i not in columns]
+    position = columns.index('last_date_retained') + 1 if 'last_date_retained' in columns else len(columns)
+    return df[columns[:position] + milestones + columns[position:]]
+
+
+def assign_fiscal_periods(df):
+    """
+    Assign the fiscal quarter and year of each client's enrollment and intake.
+    :param df: reporting_df
+    :return: Modified reporting_df featuring fiscal quarter and year columns.
+    """
+    df = assign_fiscal_quarter(df)
+    df = assign_fiscal_year(df)
+    df = assign_intake_quarter(df)
+    df = assign_intake_fy(df)
+    return df
+
+
+def get_report_stages():
+    """
+    Declare the stages that turn per-account facts into the unformatted reporting_df.
+    :return: List of pipeline stages.
+    """
+    return [pm.Stage('milestones', apply_milestones, ['account_features', 'dol_wage_records', 'as_of']),
+            pm.Stage('demographics', format_demographics, ['milestones', 'as_of']),
+            pm.Stage('fiscal_periods', assign_fiscal_periods, ['demographics'])]
+
+
+def build_account_features(accounts_df, activity_index, feature_stages=None, cache_name=None, refresh=False,
+                           parallel=False):
+    """
+    Build the per-account facts of reporting_df from accounts and their activities.
+    :param accounts_df: accounts_df
+    :param activity_index: Activities partitioned by type.
+    :param feature_stages: apply_* stages to run. Default=None runs every stage from get_feature_stages.
+    :param cache_name: Name of the pipeline cache. Default=None runs every stage without caching.
+    :param refresh: Rerun every stage. Default=False
+    :param parallel: Compute the apply_* stages at once in a process pool. Default=False
+    :return: reporting_df featuring the account data and every apply_* stage's features.
+    """
+    feature_stages = get_feature_stages() if feature_stages is None else feature_stages
+    stages = feature_stages + [pm.Stage('account_features', build_reporting_base,
+                                        ['accounts'] + [i.output for i in feature_stages])]
+    empty_df = next(iter(activity_index.values())).iloc[0:0]
+    values = {'accounts': accounts_df}
+    values.update({j: activity_index.get(j, empty_df) for i in feature_stages for j in i.inputs})
+    return pm.run_pipeline(stages, values, cache_name, refresh, parallel)['account_features']
+
+
+def build_report(facts_df, as_of=None):
+    """
+    Build the unformatted reporting_df from the per-account facts. The report stages aren't memoized, they depend on
+    the time they're calculated at so their inputs change on every run.
+    :param facts_df: reporting_df featuring the account data and every apply_* stage's features.
+    :param as_of: Timestamp time relative columns are calculated from. Default=None uses settings.now
+    :return: Unformatted reporting_df
+    """
+    values = {'account_features': facts_df, 'dol_wage_records': apply_dol_wage_records(), 'as_of': get_as_of(as_of)}
+    return pm.run_pipeline(get_report_stages(), values)['fiscal_periods']
+
+
+def update_account_features(facts_df, accounts_df, activities_df, dirty_accounts):
+    """
+    Rebuild the facts of accounts that changed since the last build and splice them into the stored facts.
+    :param facts_df: Stored reporting_df facts from the last build.
+    :param accounts_df: accounts_df
+    :param activities_df: activities_df
+    :param dirty_accounts: List of accountids with created/modified records.
+    :return: reporting_df facts with the changed accounts rebuilt.
+    """
+    if len(dirty_accounts) == 0:
+        return facts_df
+    dirty_accounts = pd.Index(dirty_accounts)
+    activity_index = build_activity_index(activities_df[activities_df['accountid'].isin(dirty_accounts)])
+    dirty_facts_df = build_account_features(accounts_df[accounts_df['id'].isin(dirty_accounts)], activity_index)
+    facts_df = facts_df[~facts_df['accountid'].isin(dirty_accounts)]
+    return pd.concat([facts_df, dirty_facts_df], ignore_index=True)
+
+
+def format_flag_columns(df):
+    """
+    Write the boolean flag columns as Yes/No for the exported report. Missing flags are left blank.
+    :param df: reporting_df
+    :return: Modified reporting_df
+    """
+    for column in df.columns:
+        if pd.api.types.is_bool_dtype(df[column]):
+            df[column] = df[column].astype(object).map({True: 'Yes', False: 'No'})
     return df
 
 
@@ -748,6 +1045,10 @@ def format_reporting_df(df):
     :return: Modified reporting_df with capitalized lettering etc.
     """
     df = df.sort_values(by=['name'])
+    # When nobody has a certification, every client is reported as not having gained one.
+    if not is_flagged(df['gained_certification']).any():
+        df['gained_certification'] = False
+    df = format_flag_columns(df)
     df = df.rename(
         columns={"accountid": "Account ID", "addresscity": "city", "maritalstatus": "Marital Status",
                  "validdriverslicense": "Valid DL", "workingvehicle": "Vehicle", "femalehh": "Female HH",
@@ -776,54 +1077,77 @@ def format_date_columns(df):
     :return: Modified reporting_df with appropriately formatted date columns.
     """
     for i in settings.date_columns:
-        df[f'{i}'] = pd.to_datetime(df[f'{i}']).dt.strftime('%m/%d/%Y')
+        df[f'{i}'] = lsm.parse_dates(df[f'{i}']).dt.strftime(settings.report_date_format)
     return df
 
 
 def format_grant_fund(df):
     """
-    Incorporate the CDBG, SNAP ID, & EARN ID columns to modify Grant Fund column to include those grants if applicable.
+    Add CDBG, SNAP and EARN to the Grant Fund column of clients that qualify for them but don't list them.
     :param df: reporting_df
     :return: Modified reporting_df
     """
-    df['Grant Fund'] = df['Grant Fund'].fillna('')
-    df['Grant Fund'] = np.where((df['Cdbg'] == 'CDBG') & (df['Grant Fund'].str.contains('CDBG') == False),
-                                (df['Grant Fund'] + '; CDBG'), df['Grant Fund'])
-    df['Grant Fund'] = np.where((df['Snap Id'].notnull() & (df['Grant Fund'].str.contains('SNAP') == False)),
-                                (df['Grant Fund'] + '; SNAP'), df['Grant Fund'])
-    df['Grant Fund'] = np.where((df['Earn Id'].notnull() & (df['Grant Fund'].str.contains('EARN') == False)),
-                                (df['Grant Fund'] + '; EARN'), df['Grant Fund'])
-    df['Grant Fund'] = df['Grant Fund'].str.lstrip(";")
-    return df
+    grant_fund = df['Grant Fund'].astype(object).fillna('')
+    for grant in ['CDBG', 'SNAP', 'EARN']:
+        grant_fund = grant_fund.where(~has_grant(df['Unlisted Grants'], grant), grant_fund + f'; {grant}')
+    df['Grant Fund'] = grant_fund.str.lstrip(";")
+    return df.drop(columns=['Grant Membership', 'Unlisted Grants'])
 
 
 
-def form_reporting_df():
+def export_reporting_df(reporting_df):
     """
-    Combine pertinent information from csv documents to develop an aggregated dataframe of RSS data.
+    Cache the unformatted reporting_df, then format it and write reporting_df.csv
+    :param reporting_df: Unformatted reporting_df
     :return: Final reporting_df
     """
-    accounts_df, activities_df = get_accounts_activities_dataframes(settings.accounts_csv, settings.activities_csv)
-    reporting_df = initiate_reporting_df(accounts_df)
-    #reporting_df = apply_returning_client_data(reporting_df, activities_df)
-    reporting_df = assign_job_coach_initials(reporting_df)
-    reporting_df = apply_employment_data(reporting_df, activities_df)
-    reporting_df = apply_retention_data(reporting_df, activities_df)
-    reporting_df = apply_cohort_data(reporting_df, activities_df)
-    reporting_df = apply_certification_data(reporting_df, activities_df)
-    reporting_df = apply_training_status_data(reporting_df, activities_df)
-    reporting_df = apply_inactive_data(reporting_df, activities_df)
-    reporting_df = apply_snap_fee_data(reporting_df, activities_df)
-    reporting_df = apply_earn_entry_exit_data(reporting_df, activities_df)
-    reporting_df = apply_grant_id_df("SNAP ID", reporting_df, activities_df)
-    reporting_df = apply_grant_id_df("EARN ID", reporting_df, activities_df)
-    reporting_df = apply_dol_wage_records(reporting_df)
-    reporting_df = format_demographics(reporting_df)
-    reporting_df = assign_fiscal_quarter(reporting_df)
-    reporting_df = assign_fiscal_year(reporting_df)
-    reporting_df = assign_intake_quarter(reporting_df)
-    reporting_df = assign_intake_fy(reporting_df)
+    lsm.write_cached_frame(reporting_df, REPORTING_DF)
     reporting_df = format_reporting_df(reporting_df)
     reporting_df = format_grant_fund(reporting_df)
     reporting_df.to_csv(settings.reporting_df_csv)
     return reporting_df
+
+
+def refresh_reporting_df(as_of=None):
+    """
+    Refresh the time relative columns of the last reporting_df without rebuilding it. Falls back to building
+    reporting_df if it hasn't been cached.
+    :param as_of: Timestamp the columns are calculated from. Default=None uses settings.now
+    :return: Final reporting_df
+    """
+    reporting_df = lsm.read_cached_frame(REPORTING_DF)
+    if reporting_df is None:
+        return form_reporting_df(as_of=as_of)
+    print(f"Refreshing Time Relative Columns As Of {get_as_of(as_of)}")
+    reporting_df = refresh_time_relative_columns(reporting_df, as_of)
+    return export_reporting_df(reporting_df)
+
+
+def form_reporting_df(full_rebuild=False, as_of=None, parallel=False):
+    """
+    Combine pertinent information from csv documents to develop an aggregated dataframe of RSS data. Only accounts
+    with records created/modified since the dirty accounts were last cleared are rebuilt, unless the stored facts are
+    missing.
+    :param full_rebuild: Rebuild every account from scratch. Default=False
+    :param as_of: Timestamp time relative columns are calculated from. Default=None uses settings.now
+    :param parallel: Compute the apply_* stages of a full build at once in a process pool. Default=False
+    :return: Final reporting_df
+    """
+    if lsm.has_pending_segments():
+        # A sync was interrupted after storing records, so their accounts are dirty but not in the typed caches yet.
+        print("Refreshing The Typed Caches With Records From An Unfinished Sync")
+        lsm.refresh_record_caches()
+    accounts_df, activities_df = get_accounts_activities_dataframes()
+    dirty_accounts = lsm.read_dirty_accounts()
+    facts_df = None if full_rebuild else lsm.read_cached_frame(REPORTING_FACTS)
+    if facts_df is None:
+        print("Rebuilding reporting_df For Every Account")
+        # The stored facts take the place of a pipeline cache, so a full build runs every stage.
+        reporting_df = build_account_features(accounts_df, build_activity_index(activities_df), parallel=parallel)
+    else:
+        print(f"Rebuilding reporting_df For {len(dirty_accounts)} Changed Accounts")
+        reporting_df = update_account_features(facts_df, accounts_df, activities_df, dirty_accounts)
+    # The dirty accounts are cleared by organize_data once every report built from them has been written.
+    lsm.write_cached_frame(reporting_df, REPORTING_FACTS)
+    reporting_df = build_report(reporting_df, as_of)
+    return export_reporting_df(reporting_df)
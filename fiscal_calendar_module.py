@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+from settings_RSS import Settings
+
+settings = Settings()
+
+
+def build_month_lookups(start_month):
+    """
+    Build the lookup arrays that map a calendar month to its fiscal quarter and fiscal year offset. Fiscal years are
+    named after the calendar year they end in. Index 0 stands for a missing date.
+    :param start_month: Calendar month the fiscal year starts in.
+    :return: Tuple of the quarter and year offset arrays, indexed by calendar month.
+    """
+    months = np.arange(1, 13)
+    quarters = (months - start_month) % 12 // 3 + 1
+    offsets = (months >= start_month).astype(int) if start_month > 1 else np.zeros(12, dtype=int)
+    return np.concatenate([[0], quarters]), np.concatenate([[0], offsets])
+
+
+MONTH_TO_QUARTER, MONTH_TO_YEAR_OFFSET = build_month_lookups(settings.fiscal_year_start_month)
+QUARTER_NAMES = ['Quarter 1', 'Quarter 2', 'Quarter 3', 'Quarter 4']
+
+
+def get_months(dates):
+    """
+    Identify the calendar month of each date, using 0 for missing dates so it can index the lookup arrays.
+    :param dates: Datetime series.
+    :return: Integer array of calendar months.
+    """
+    return dates.dt.month.fillna(0).to_numpy(dtype=int)
+
+
+def fiscal_year(dates):
+    """
+    Map each date to its fiscal year.
+    :param dates: Datetime series.
+    :return: Integer series of fiscal years, 0 for missing dates.
+    """
+    years = dates.dt.year.fillna(0).to_numpy(dtype=int)
+    return pd.Series(years + MONTH_TO_YEAR_OFFSET[get_months(dates)], index=dates.index)
+
+
+def fiscal_quarter(dates):
+    """
+    Map each date to its fiscal quarter.
+    :param dates: Datetime series.
+    :return: Categorical series of 'Quarter 1' through 'Quarter 4', empty for missing dates.
+    """
+    codes = MONTH_TO_QUARTER[get_months(dates)] - 1
+    return pd.Series(pd.Categorical.from_codes(codes, QUARTER_NAMES), index=dates.index)
+
+
+def get_fiscal_year(date=None):
+    """
+    Identify the fiscal year of a single date.
+    :param date: Date to look up. Default=None uses today's date.
+    :return: Fiscal year
+    """
+    date = pd.Timestamp('now') if date is None else pd.Timestamp(date)
+    return date.year + int(MONTH_TO_YEAR_OFFSET[date.month])
+
+
+def get_fiscal_year_bounds(year):
+    """
+    Identify the first day of a fiscal year and the first day of the next.
+    :param year: Fiscal year
+    :return: Tuple of the fiscal year's start and end timestamps. The end is excluded from the year.
+    """
+    start = pd.Timestamp(year - int(MONTH_TO_YEAR_OFFSET[settings.fiscal_year_start_month]),
+                         settings.fiscal_year_start_month, 1)
+    return start, start + pd.DateOffset(years=1)
+
+
+def partition_by_fiscal_year(df, dates, years=None):
+    """
+    Split a frame into a frame for each fiscal year. Rows are sorted by fiscal year a single time and each year's
+    rows are found by binary search.
+    :param df: Dataframe to partition.
+    :param dates: Datetime series aligned with the dataframe that rows are partitioned by.
+    :param years: Fiscal years to partition into, every year gets a frame even if it's empty. Default=None uses every
+    year that has rows.
+    :return: Dictionary of fiscal year and dataframe. Rows without a date are left out.
+    """
+    row_years = fiscal_year(dates).to_numpy()
+    order = np.argsort(row_years, kind='stable')
+    sorted_years = row_years[order]
+    if years is None:
+        years = [i for i in np.unique(sorted_years) if i != 0]
+    starts = np.searchsorted(sorted_years, years, side='left')
+    ends = np.searchsorted(sorted_years, years, side='right')
+    return {int(year): df.iloc[order[start:end]] for year, start, end in zip(years, starts, ends)}
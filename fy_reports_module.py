@@ -1,30 +1,22 @@
 import pandas as pd
-from datetime import date
 import data_manipulation_module as dmm
 import xlsxwriter
 import client_directories_module as cdm
 import numpy as np
+import local_store_module as lsm
+import fiscal_calendar_module as fcm
 from settings_RSS import Settings
 
 settings = Settings()
 
 
-def get_ytd_dataframes(year):
+def partition_fy_accounts(years):
     """
-    Produce dataframes that only contain accounts and activities recorded during a specified fiscal year.
-    :param year: The fiscal year on report.
-    :return: activities_df and accounts_df for the specific fiscal year.
+    Partition the accounts by the fiscal year of their enrollment.
+    :param years: Fiscal years on report.
+    :return: Dictionary of fiscal year and the accounts_df of that year.
     """
-
-    # noinspection PyTypeChecker
-    beginning = pd.Timestamp(date(year - 1, 7, 1))
-    ending = pd.Timestamp(date(year, 7, 1))
-
-    activities_df = pd.read_csv(settings.activities_csv)
-
-    activities_df = activities_df[pd.to_datetime(activities_df['createddate']) >= beginning].copy()
-
-    accounts_df = pd.read_csv(settings.accounts_csv)
+    accounts_df = lsm.read_cached_records(settings.accounts_url)
 
     reporting_df = pd.read_csv(settings.reporting_df_csv)
 
@@ -38,47 +30,46 @@ def get_ytd_dataframes(year):
          accounts_df['Original Training Program'].str.contains('CTC|MTDL|CF')), accounts_df['Cohort Date'],
         accounts_df['Original Intake Date'])
 
-    accounts_df = accounts_df[
-        (pd.to_datetime(accounts_df['enrollment_date'], errors='coerce') >= beginning) &
-        (pd.to_datetime(accounts_df['enrollment_date'], errors='coerce') < ending)].copy()
+    enrollment_date = lsm.parse_dates(accounts_df['enrollment_date'], settings.report_date_format)
+    accounts_df = accounts_df.drop(columns=['Original Intake Date', 'Original Training Program', 'Enrollment Satisfied',
+                                            'Cohort Date', 'enrollment_date'])
 
-    del accounts_df['Original Intake Date']
-    del accounts_df['Original Training Program']
-    del accounts_df['Enrollment Satisfied']
-    del accounts_df['Cohort Date']
-    del accounts_df['enrollment_date']
+    return fcm.partition_by_fiscal_year(accounts_df, enrollment_date, years)
 
-    return activities_df, accounts_df
+
+def get_ytd_dataframes(year, activity_index, accounts_df):
+    """
+    Produce dataframes that only contain accounts and activities recorded during a specified fiscal year.
+    :param year: The fiscal year on report.
+    :param activity_index: Activities of every year partitioned by type.
+    :param accounts_df: Accounts enrolled during the fiscal year.
+    :return: activity index and accounts_df for the specific fiscal year.
+    """
+    # Activities recorded after the fiscal year are kept, they report the outcomes of the year's enrollments.
+    beginning = fcm.get_fiscal_year_bounds(year)[0]
+    ytd_activity_index = {k: v[lsm.parse_dates(v['createddate']) >= beginning] for k, v in activity_index.items()}
+    return ytd_activity_index, accounts_df.copy()
 
 
-def build_ytd_report(year):
+def build_ytd_report(year, activity_index, accounts_df, parallel=False):
     """
     Build a reporting_df for the specific fiscal year.
     :param year: Fiscal year
+    :param activity_index: Activities of every year partitioned by type.
+    :param accounts_df: Accounts enrolled during the fiscal year.
+    :param parallel: Compute the apply_* stages at once in a process pool. Default=False
     :return:
     """
-    activities_df, accounts_df = get_ytd_dataframes(year)
-    reporting_df = dmm.initiate_reporting_df(accounts_df)
-    #reporting_df = dmm.apply_returning_client_data(reporting_df, activities_df)
-    reporting_df = dmm.assign_job_coach_initials(reporting_df)
-    reporting_df = dmm.apply_employment_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_retention_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_cohort_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_certification_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_training_status_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_inactive_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_snap_fee_data(reporting_df, activities_df)
-    reporting_df = dmm.apply_grant_id_df("SNAP ID", reporting_df, activities_df)
-    reporting_df = dmm.apply_grant_id_df("EARN ID", reporting_df, activities_df)
-    reporting_df = dmm.apply_dol_wage_records(reporting_df)
-    reporting_df = dmm.format_demographics(reporting_df)
-    reporting_df = dmm.assign_fiscal_quarter(reporting_df)
-    reporting_df = dmm.assign_fiscal_year(reporting_df)
-    reporting_df = dmm.assign_intake_quarter(reporting_df)
-    reporting_df = dmm.assign_intake_fy(reporting_df)
+    ytd_activity_index, accounts_df = get_ytd_dataframes(year, activity_index, accounts_df)
+    # FY reports don't include EARN entry/exit dates.
+    feature_stages = [i for i in dmm.get_feature_stages() if i.name != 'earn_entry_exit']
+    reporting_df = dmm.build_account_features(accounts_df, ytd_activity_index, feature_stages, f"FY {year}",
+                                              parallel=parallel)
+    reporting_df = dmm.build_report(reporting_df)
     reporting_df = dmm.format_reporting_df(reporting_df)
     reporting_df = dmm.format_grant_fund(reporting_df)
-    reporting_df = dmm.coerce_to_datetime(reporting_df,'Original Intake Date','Cohort Date')
+    reporting_df = dmm.coerce_to_datetime(reporting_df,'Original Intake Date','Cohort Date',
+                                          date_format=settings.report_date_format)
     current_fy_reports = [f"\FY {year} Report.xlsx", f"\FY {year} Performance Report.xlsx"]
     if (year == pd.Timestamp('now').year) | (year == pd.Timestamp('now').year +1):
         for report_name in current_fy_reports:
@@ -104,27 +95,16 @@ def build_ytd_report(year):
                 cdm.write_excel(filename, 'Certifications', reporting_df[reporting_df['Gained Certification'] == 'Yes'][settings.kpi_certifications]) #todo this could be a while loop
 
 
-# noinspection PyTypeChecker
-def calculate_fiscal_year():
-    """
-    Calculate the fiscal year based on today's date.
-    :return: fiscal year
-    """
-    year = pd.Timestamp('now').year
-    month = pd.Timestamp('now').month
-
-    if month >= 7:
-        year += 1
-    return year
-
-
-def update_fy_reports():
+def update_fy_reports(parallel=False):
     """
     Updates fiscal year reports dating back to FY2020
+    :param parallel: Compute each report's apply_* stages at once in a process pool. Default=False
     :return:
     """
-    fiscal_year = calculate_fiscal_year()
+    fiscal_year = fcm.get_fiscal_year()
     years = [i for i in range(2020, (fiscal_year + 1))]
+    activity_index = dmm.build_activity_index(lsm.read_cached_records(settings.activities_url))
+    fy_accounts = partition_fy_accounts(years)
 
     for year in years:
-        build_ytd_report(year)
+        build_ytd_report(year, activity_index, fy_accounts[year], parallel)
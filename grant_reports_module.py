@@ -1,62 +1,188 @@
+import os
+import hashlib
+import numpy as np
 import pandas as pd
 import json
 from settings_RSS import Settings
 from client_directories_module import write_excel
+import local_store_module as lsm
+import data_manipulation_module as dmm
+import pipeline_module as pm
 import xlsxwriter
 
 settings = Settings()
 
-def write_grant_reports():
+
+def get_cycle_anchors(df):
+    """
+    Parse the column each grant's cycles are drawn from a single time, leaving the exported columns as they are.
+    :param df: reporting_df
+    :return: Dictionary of grant and anchor series. Grants without their own anchor use the 'default' entry.
+    """
+    return {'SNAP': lsm.parse_dates(df['Initial Confirmation'], settings.confirmation_date_format),
+            'EARN': lsm.parse_dates(df['Earn Entry']),
+            'CDBG': df['Fiscal Year'],
+            'default': lsm.parse_dates(df['Original Intake Date'], settings.report_date_format)}
+
+
+def build_grant_index(grant_membership, anchor, grant):
+    """
+    Sort a grant's members by their anchor so the rows of each cycle can be found by binary search.
+    :param grant_membership: Series of grant membership bitmasks.
+    :param anchor: Series the grant's cycles are drawn from.
+    :param grant: Grant in settings.accepted_grants
+    :return: Tuple of the sorted anchor values and the row positions in the same order.
+    """
+    rows = np.flatnonzero(dmm.has_grant(grant_membership, grant).to_numpy() & anchor.notnull().to_numpy())
+    values = anchor.to_numpy()[rows]
+    order = np.argsort(values, kind='stable')
+    return values[order], rows[order]
+
+
+def get_cycle_bounds(grant, cycle):
+    """
+    Identify the anchor values a cycle starts at and ends before. CDBG cycles are drawn by the
+    fiscal year matching the calendar year of the cycle's end date.
+    :param grant: Grant
+    :param cycle: Dictionary of the cycle's start and end dates.
+    :return: Tuple of the cycle's start and end values.
+    """
+    start_date = pd.Timestamp(cycle["start"])
+    end_date = pd.Timestamp(cycle["end"])
+    if grant == 'CDBG':
+        return end_date.year, end_date.year + 1
+    return start_date.to_datetime64(), end_date.to_datetime64()
+
+
+def select_cycle_rows(grant_index, start, end):
+    """
+    Find the rows of a cycle in a grant's index.
+    :param grant_index: Tuple of sorted anchor values and row positions from build_grant_index.
+    :param start: Anchor value the cycle starts at.
+    :param end: Anchor value the cycle ends before.
+    :return: Row positions of the cycle, in reporting_df order.
+    """
+    values, rows = grant_index
+    return np.sort(rows[np.searchsorted(values, start, side='left'):np.searchsorted(values, end, side='left')])
+
+
+def hash_cycle_members(cycle_df, dol_wage_records_df):
+    """
+    Hash the accounts that make up a cycle and their DOL wage records, so a closed cycle is rewritten if an account
+    joins or leaves it or its members' wage records change. Wage records aren't synced from RSS, so they never mark an
+    account as changed.
+    :param cycle_df: Dataframe of the cycle's clients.
+    :param dol_wage_records_df: Dataframe of DOL wage records indexed by accountid.
+    :return: Hex digest of the cycle's accountids and wage records.
+    """
+    accountids = np.sort(cycle_df['Account Id'].to_numpy(dtype='int64'))
+    digest = hashlib.sha256(accountids.tobytes())
+    wage_records = dol_wage_records_df[dol_wage_records_df.index.isin(accountids)].sort_index(kind='mergesort')
+    digest.update(pm.hash_value(wage_records).encode())
+    return digest.hexdigest()
+
+
+def read_grant_cycle_history():
+    """
+    Read the member hashes of the grant cycles that have been written.
+    :return: Dictionary of '<grant>_<cycle>' and member hash.
+    """
+    if not os.path.exists(settings.grant_cycle_history):
+        return {}
+    with open(settings.grant_cycle_history, 'r') as file:
+        return json.load(file)
+
+
+def write_grant_cycle_history(history):
+    """
+    Record the member hashes of the grant cycles that have been written.
+    :param history: Dictionary of '<grant>_<cycle>' and member hash.
+    :return:
+    """
+    with open(settings.grant_cycle_history, 'w') as file:
+        json.dump(history, file, indent=4)
+
+
+def is_cycle_frozen(cycle, cycle_df, filename, recorded_hash, member_hash, changed_accounts):
+    """
+    Determine whether a cycle's workbook can be left as it is. A cycle is frozen once it has ended, unless its
+    workbook is missing, its members or their wage records changed, or one of its members' records changed.
+    :param cycle: Dictionary of the cycle's start and end dates.
+    :param cycle_df: Dataframe of the cycle's clients.
+    :param filename: Path of the cycle's workbook.
+    :param recorded_hash: Member hash recorded when the workbook was last written, if any.
+    :param member_hash: Member hash of the cycle now.
+    :param changed_accounts: Set of accountids whose records changed since the last run.
+    :return: True if the cycle doesn't need to be rewritten.
+    """
+    return (pd.Timestamp(cycle["end"]) <= settings.now and
+            os.path.exists(filename) and
+            recorded_hash == member_hash and
+            not cycle_df['Account Id'].isin(changed_accounts).any())
+
+
+def write_cycle_report(filename, cycle_df):
+    """
+    Write the Data, KPIs, Employments and Certifications sheets of a cycle's workbook.
+    :param filename: Path of the cycle's workbook.
+    :param cycle_df: Dataframe of the cycle's clients.
+    :return:
+    """
+    cycle_kpi_df = cycle_df[settings.kpi_columns].copy()
+    cycle_employments = cycle_df[cycle_df['Gained Employment'] == 'Yes'][settings.kpi_employments].copy()
+    cycle_certifications = cycle_df[cycle_df['Gained Certification'] == 'Yes'][settings.kpi_certifications].copy()
+    while True:
+        try:
+            write_excel(filename,'Data',cycle_df)
+            write_excel(filename,'KPIs', cycle_kpi_df)
+            write_excel(filename, 'Employments', cycle_employments)
+            write_excel(filename, 'Certifications', cycle_certifications)
+            break
+        except FileNotFoundError:
+            print("File Doesn't Exist Yet, Let Me Make It!")
+            workbook = xlsxwriter.Workbook(filename)
+            workbook.add_worksheet('Data')
+            workbook.add_worksheet('KPIs')
+            workbook.add_worksheet('Employments')
+            workbook.add_worksheet('Certifications')
+            workbook.close()
+            print(f"{filename} created!")
+        except KeyError:
+            print(f"Unknown Keyerror ocurred when updating {filename}")
+
+
+def write_grant_reports(changed_accounts=(), refresh=False):
+    """
+    Write a workbook for each grant cycle. Each grant's members are indexed by the cycle's anchor date once and every
+    cycle is pulled from the index by binary search. Closed cycles are skipped unless they changed.
+    :param changed_accounts: Accountids whose records changed since the last run. Default=()
+    :param refresh: Rewrite every cycle, including closed cycles. Default=False
+    :return:
+    """
     df = pd.read_csv(settings.reporting_df_csv)
+    anchors = get_cycle_anchors(df)
+    grant_membership = dmm.get_grant_membership(df['Grant Fund'])
+    dol_wage_records_df = dmm.apply_dol_wage_records()
+    changed_accounts = set(changed_accounts)
+    history = read_grant_cycle_history()
 
     grant_cycles = json.loads(settings.grant_cycles)
     for grant in grant_cycles:
         print(grant)
+        if grant not in settings.accepted_grants:
+            print(f"{grant} isn't in settings.accepted_grants, none of its cycles have clients.")
+        grant_index = build_grant_index(grant_membership, anchors.get(grant, anchors['default']), grant)
         for cycle in grant_cycles[f"{grant}"]:
             print(cycle)
-            start_date = grant_cycles[f"{grant}"][f"{cycle}"]["start"]
-            end_date = grant_cycles[f"{grant}"][f"{cycle}"]["end"]
-            if grant == 'SNAP':
-                cycle_df = df[
-                    (df["Grant Fund"].str.contains(f"{grant}")) &
-                    (pd.to_datetime(df["Initial Confirmation"], errors='coerce') >= pd.to_datetime(start_date)) &
-                    (pd.to_datetime(df['Initial Confirmation'], errors='coerce') < pd.to_datetime(end_date))]
-            elif grant == 'EARN':
-                cycle_df = df[
-                    (df["Grant Fund"].str.contains(f"{grant}")) &
-                    (pd.to_datetime(df["Earn Entry"], errors='coerce') >= pd.to_datetime(start_date)) &
-                    (pd.to_datetime(df['Earn Entry'], errors='coerce') < pd.to_datetime(end_date))]
-            elif grant == 'CDBG':
-                cycle_df = df[
-                    (df['Fiscal Year'] == pd.to_datetime(end_date).year) &
-                    (df["Grant Fund"].str.contains(f"{grant}"))
-                ]
-            else:
-                cycle_df = df[
-                    (df["Grant Fund"].str.contains(f"{grant}")) &
-                    (pd.to_datetime(df["Original Intake Date"], errors='coerce') >= pd.to_datetime(start_date)) &
-                    (pd.to_datetime(df['Original Intake Date'], errors='coerce') < pd.to_datetime(end_date))]
-            print(f"{len(cycle_df)} clients in {grant}-{cycle}")
+            cycle_df = df.iloc[select_cycle_rows(grant_index, *get_cycle_bounds(grant, grant_cycles[grant][cycle]))]
             filename = f"{settings.grant_reports_path}\\{grant}_{cycle}.xlsx"
-
-            cycle_kpi_df = cycle_df[settings.kpi_columns].copy()
-            cycle_employments = cycle_df[cycle_df['Gained Employment'] == 'Yes'][settings.kpi_employments].copy()
-            cycle_certifications = cycle_df[cycle_df['Gained Certification'] == 'Yes'][settings.kpi_certifications].copy()
-            while True:
-                try:
-                    write_excel(filename,'Data',cycle_df)
-                    write_excel(filename,'KPIs', cycle_kpi_df)
-                    write_excel(filename, 'Employments', cycle_employments)
-                    write_excel(filename, 'Certifications', cycle_certifications)
-                    break
-                except FileNotFoundError:
-                    print("File Doesn't Exist Yet, Let Me Make It!")
-                    workbook = xlsxwriter.Workbook(filename)
-                    workbook.add_worksheet('Data')
-                    workbook.add_worksheet('KPIs')
-                    workbook.add_worksheet('Employments')
-                    workbook.add_worksheet('Certifications')
-                    workbook.close()
-                    print(f"{filename} created!")
-                except KeyError:
-                    print(f"Unknown Keyerror ocurred when updating {filename}")
+            key = f"{grant}_{cycle}"
+            member_hash = hash_cycle_members(cycle_df, dol_wage_records_df)
+            if not refresh and is_cycle_frozen(grant_cycles[grant][cycle], cycle_df, filename, history.get(key),
+                                               member_hash, changed_accounts):
+                print(f"{grant}-{cycle} is closed and unchanged, skipping.")
+                continue
+            print(f"{len(cycle_df)} clients in {grant}-{cycle}")
+            write_cycle_report(filename, cycle_df)
+            history[key] = member_hash
+            write_grant_cycle_history(history)
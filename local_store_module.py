@@ -0,0 +1,420 @@
+import os
+import json
+import threading
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+from settings_RSS import Settings
+
+settings = Settings()
+
+COMPACTED_FILE = 'compacted.csv'
+SEGMENT_PREFIX = 'segment_'
+SEEDED_MARKER = 'seeded'
+
+dirty_accounts_lock = threading.Lock()
+
+
+def get_record_name(record_type):
+    """
+    Identify the name the local store uses for a record type.
+    :param record_type: Accounts or Activities url.
+    :return: 'accounts' or 'activities'
+    """
+    return 'accounts' if record_type == settings.accounts_url else 'activities'
+
+
+def parse_dates(series, date_format=None):
+    """
+    Parse a column of dates a single time. Columns that are already datetimes are returned as they are. Dates are
+    parsed with an explicit format and only values that don't match it fall back to format inference.
+    :param series: Column of dates.
+    :param date_format: Format of the dates. Default=None uses settings.rss_date_format
+    :return: Datetime series.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    date_format = settings.rss_date_format if date_format is None else date_format
+    parsed = pd.to_datetime(series, format=date_format, errors='coerce')
+    unmatched = parsed.isnull() & series.notnull()
+    if unmatched.any():
+        parsed[unmatched] = pd.to_datetime(series[unmatched], errors='coerce')
+    return parsed
+
+
+def get_partition_month(df):
+    """
+    Identify the month each record was created. A record's created date never changes, so every version of a
+    record is stored in the same partition.
+    :param df: Dataframe of accounts or activities.
+    :return: Series of 'YYYY-MM' partition names.
+    """
+    return parse_dates(df['createddate']).dt.strftime('%Y-%m').fillna('unknown')
+
+
+def get_partition_path(record_name, month, activity_type=''):
+    """
+    Build the directory path of a partition.
+    :param record_name: 'accounts' or 'activities'
+    :param month: 'YYYY-MM' partition name.
+    :param activity_type: Type of activity if record_name is activities. Default=''
+    :return: Directory path of the partition.
+    """
+    if record_name == 'accounts':
+        return os.path.join(settings.local_store_path, record_name, month)
+    return os.path.join(settings.local_store_path, record_name, activity_type, month)
+
+
+def append_segment(df, record_type):
+    """
+    Append created/modified records to the local store as new segment files, without reading existing data.
+    :param df: Dataframe of created/modified records.
+    :param record_type: Accounts or Activities url.
+    :return: List of partitions that received a new segment.
+    """
+    if df is None or df.empty:
+        return []
+    record_name = get_record_name(record_type)
+    segment_name = f"{SEGMENT_PREFIX}{dt.now().strftime('%Y%m%d%H%M%S%f')}.csv"
+    keys = get_partition_month(df) if record_name == 'accounts' else [df['type'], get_partition_month(df)]
+    partitions = []
+    for key, segment_df in df.groupby(keys):
+        if record_name == 'accounts':
+            path = get_partition_path(record_name, key)
+        else:
+            path = get_partition_path(record_name, key[1], key[0])
+        os.makedirs(path, exist_ok=True)
+        segment_df.to_csv(os.path.join(path, segment_name), index=False)
+        partitions.append(path)
+    print(f"{len(df)} {record_name} records appended to {len(partitions)} partitions.")
+    return partitions
+
+
+def list_partitions(record_name):
+    """
+    List every partition directory of a record type.
+    :param record_name: 'accounts' or 'activities'
+    :return: List of partition directory paths.
+    """
+    partitions = []
+    for root, dirs, files in os.walk(os.path.join(settings.local_store_path, record_name)):
+        if any(f.endswith('.csv') for f in files):
+            partitions.append(root)
+    return sorted(partitions)
+
+
+def list_segments(path):
+    """
+    List the uncompacted segment files of a partition, oldest first.
+    :param path: Partition directory path.
+    :return: List of segment file paths.
+    """
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.startswith(SEGMENT_PREFIX))
+
+
+def keep_latest_records(df):
+    """
+    Keep a single row for each id, choosing the row with the latest modified date.
+    :param df: Dataframe of accounts or activities.
+    :return: Dataframe with one row per id.
+    """
+    df = df.assign(_modified=parse_dates(df['modifieddate']))
+    df = df.sort_values('_modified', kind='mergesort', na_position='first')
+    return df.drop_duplicates(subset=['id'], keep='last').drop(columns='_modified')
+
+
+def upsert_by_id(table_df, delta_df, key='id'):
+    """
+    Insert or replace rows of a table by primary key. Ids are matched through the table's hash index, so only rows
+    in the delta are looked up and replaced. A delta row only replaces a stored row if it isn't older.
+    :param table_df: Dataframe of stored records.
+    :param delta_df: Dataframe of created/modified records.
+    :param key: Primary key column. Default='id'
+    :return: Dataframe with exactly one row per id.
+    """
+    if not table_df[key].is_unique:
+        table_df = keep_latest_records(table_df)
+    table = table_df.set_index(key)
+    delta = keep_latest_records(delta_df).set_index(key)
+    for column in delta.columns.difference(table.columns):
+        table[column] = np.nan
+    existing_ids = delta.index.intersection(table.index)
+    delta_modified = parse_dates(delta.loc[existing_ids, 'modifieddate'])
+    table_modified = parse_dates(table.loc[existing_ids, 'modifieddate'])
+    replaced_ids = existing_ids[~(delta_modified < table_modified).to_numpy()]
+    table.loc[replaced_ids, delta.columns] = delta.loc[replaced_ids, delta.columns]
+    new_rows = delta.loc[delta.index.difference(table.index)]
+    return pd.concat([table, new_rows]).reset_index()
+
+
+def read_partition(path):
+    """
+    Read the compacted file of a partition and upsert any newer segments into it. Columns are read as text so every
+    partition agrees on their type, declared types are applied by apply_schema.
+    :param path: Partition directory path.
+    :return: Dataframe of the partition's records with one row per id.
+    """
+    compacted_file = os.path.join(path, COMPACTED_FILE)
+    segments = [pd.read_csv(f, dtype=str) for f in list_segments(path)]
+    if not os.path.exists(compacted_file):
+        return keep_latest_records(pd.concat(segments))
+    df = pd.read_csv(compacted_file, dtype=str)
+    if len(segments) == 0:
+        return df
+    return upsert_by_id(df, pd.concat(segments))
+
+
+def compact_partition(path):
+    """
+    Merge a partition's segments into its compacted file, keeping the latest version of each id.
+    :param path: Partition directory path.
+    :return:
+    """
+    segments = list_segments(path)
+    if len(segments) == 0:
+        return
+    df = read_partition(path)
+    temp_file = os.path.join(path, f"{COMPACTED_FILE}.tmp")
+    df.to_csv(temp_file, index=False)
+    os.replace(temp_file, os.path.join(path, COMPACTED_FILE))
+    for segment in segments:
+        os.remove(segment)
+
+
+def compact_store(partitions=None):
+    """
+    Compact partitions of the local store. Only partitions with new segments are rewritten.
+    :param partitions: Partitions to compact. Default=None compacts every partition.
+    :return:
+    """
+    if partitions is None:
+        partitions = list_partitions('accounts') + list_partitions('activities')
+    for path in set(partitions):
+        compact_partition(path)
+    print(f"Local Store Compacted: {len(set(partitions))} partitions checked.")
+
+
+def seed_store_from_csv(record_type, csv_file):
+    """
+    Populate an empty partition tree from an existing accounts.csv or Activities.csv.
+    :param record_type: Accounts or Activities url.
+    :param csv_file: accounts.csv or Activities.csv
+    :return:
+    """
+    print(f"Seeding the local store from {csv_file}")
+    compact_store(append_segment(pd.read_csv(csv_file), record_type))
+
+
+def seed_store(record_type):
+    """
+    Seed the local store of a record type from accounts.csv or Activities.csv the first time it's used. This has to
+    run before the first sync appends its records, otherwise the store would only hold the delta.
+    :param record_type: Accounts or Activities url.
+    :return:
+    """
+    record_name = get_record_name(record_type)
+    marker_file = os.path.join(settings.local_store_path, record_name, SEEDED_MARKER)
+    if os.path.exists(marker_file):
+        return
+    csv_file = settings.accounts_csv if record_name == 'accounts' else settings.activities_csv
+    seed_store_from_csv(record_type, csv_file)
+    # Seeding over records an earlier sync already appended is safe, stored records are only replaced by newer ones.
+    os.makedirs(os.path.dirname(marker_file), exist_ok=True)
+    with open(marker_file, 'w') as f:
+        f.write(dt.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def read_records(record_type):
+    """
+    Produce a merged view of every partition of a record type.
+    :param record_type: Accounts or Activities url.
+    :return: Dataframe with the latest version of every record.
+    """
+    seed_store(record_type)
+    df = pd.concat([read_partition(path) for path in list_partitions(get_record_name(record_type))])
+    # Partitions hold disjoint ids unless a record changed activity type, so a full dedupe is rarely needed.
+    if not df['id'].is_unique:
+        df = keep_latest_records(df)
+    return df.reset_index(drop=True)
+
+
+def get_record_schema(record_type):
+    """
+    Identify the declared schema of a record type.
+    :param record_type: Accounts or Activities url.
+    :return: Dictionary of column names and their declared types.
+    """
+    return settings.accounts_schema if record_type == settings.accounts_url else settings.activities_schema
+
+
+def apply_schema(df, schema):
+    """
+    Convert columns to their declared types. Dates are parsed a single time here rather than in every report.
+    Undeclared columns are left as text.
+    :param df: Dataframe of accounts or activities.
+    :param schema: Dictionary of column names and their declared types.
+    :return: Dataframe with typed columns.
+    """
+    for column, column_type in schema.items():
+        if column not in df.columns:
+            continue
+        if column_type == 'datetime':
+            df[column] = parse_dates(df[column])
+        elif column_type == 'numeric':
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        else:
+            df[column] = df[column].astype(column_type)
+    return df
+
+
+def get_cache_file(name, extension):
+    """
+    Build the path of a cached dataframe.
+    :param name: Name of the cached dataframe.
+    :param extension: '.parquet' or '.pkl'
+    :return: Path of the cache file.
+    """
+    return os.path.join(settings.cache_path, f"{name}{extension}")
+
+
+def write_cached_frame(df, name):
+    """
+    Write a typed dataframe to the cache as Parquet, falling back to a pickle if pyarrow isn't installed.
+    :param df: Dataframe to cache.
+    :param name: Name of the cached dataframe.
+    :return:
+    """
+    os.makedirs(settings.cache_path, exist_ok=True)
+    try:
+        df.to_parquet(get_cache_file(name, '.parquet'), index=False)
+    except ImportError:
+        df.to_pickle(get_cache_file(name, '.pkl'))
+
+
+def read_cached_frame(name):
+    """
+    Read a typed dataframe from the cache.
+    :param name: Name of the cached dataframe.
+    :return: Cached dataframe, or None if it hasn't been cached.
+    """
+    try:
+        if os.path.exists(get_cache_file(name, '.parquet')):
+            return pd.read_parquet(get_cache_file(name, '.parquet'))
+    except ImportError:
+        pass
+    if os.path.exists(get_cache_file(name, '.pkl')):
+        return pd.read_pickle(get_cache_file(name, '.pkl'))
+    return None
+
+
+def write_record_cache(record_type):
+    """
+    Refresh the typed cache of a record type from the merged view of the local store.
+    :param record_type: Accounts or Activities url.
+    :return: Typed dataframe of the record type.
+    """
+    df = apply_schema(read_records(record_type), get_record_schema(record_type))
+    write_cached_frame(df, get_record_name(record_type))
+    print(f"Cached {len(df)} {get_record_name(record_type)} records.")
+    return df
+
+
+def has_pending_segments():
+    """
+    Check whether the local store holds segments that haven't been compacted, which happens when a sync is
+    interrupted before the typed caches are refreshed.
+    :return: True if any partition has segments.
+    """
+    return any(len(list_segments(path)) > 0 for path in list_partitions('accounts') + list_partitions('activities'))
+
+
+def merge_record_cache(record_type, partitions):
+    """
+    Merge the uncompacted segments of a record type into its typed cache, so only the records synced since the last
+    refresh are read from the local store. The cache is built from the whole store if it doesn't exist yet.
+    :param record_type: Accounts or Activities url.
+    :param partitions: Partitions of the record type that have segments.
+    :return:
+    """
+    record_name = get_record_name(record_type)
+    schema = get_record_schema(record_type)
+    df = read_cached_frame(record_name)
+    if df is None:
+        write_record_cache(record_type)
+        return
+    if len(partitions) == 0:
+        return
+    delta_df = apply_schema(pd.concat([pd.read_csv(f, dtype=str) for path in partitions for f in list_segments(path)]),
+                            schema)
+    # Categories of the cache and the delta can differ, so the declared types are applied again after merging.
+    df = apply_schema(keep_latest_records(pd.concat([df, delta_df])).reset_index(drop=True), schema)
+    write_cached_frame(df, record_name)
+    print(f"Merged {len(delta_df)} {record_name} records into the cache of {len(df)}.")
+
+
+def refresh_record_caches():
+    """
+    Merge the records synced since the last refresh into the typed caches of accounts and activities, then compact
+    the partitions that received them.
+    :return:
+    """
+    # Includes segments appended before an interruption.
+    partitions = {i: [j for j in list_partitions(i) if len(list_segments(j)) > 0] for i in ['accounts', 'activities']}
+    merge_record_cache(settings.accounts_url, partitions['accounts'])
+    merge_record_cache(settings.activities_url, partitions['activities'])
+    compact_store(partitions['accounts'] + partitions['activities'])
+
+
+def read_cached_records(record_type):
+    """
+    Read the typed cache of a record type, building it from the local store if it doesn't exist yet.
+    :param record_type: Accounts or Activities url.
+    :return: Typed dataframe of the record type.
+    """
+    df = read_cached_frame(get_record_name(record_type))
+    if df is None:
+        df = write_record_cache(record_type)
+    return df
+
+
+def read_dirty_accounts():
+    """
+    Read the accounts whose records have changed since reporting_df was last built.
+    :return: List of accountids.
+    """
+    if not os.path.exists(settings.dirty_accounts_json):
+        return []
+    with open(settings.dirty_accounts_json) as f:
+        return json.load(f)
+
+
+def write_dirty_accounts(accountids):
+    """
+    Write dirty_accounts.json. Callers hold dirty_accounts_lock.
+    :param accountids: Set of accountids.
+    :return:
+    """
+    with open(settings.dirty_accounts_json, 'w') as f:
+        json.dump(sorted(accountids), f)
+
+
+def mark_dirty_accounts(df, record_type):
+    """
+    Record the accounts of created/modified records so reporting_df can rebuild only those accounts.
+    :param df: Dataframe of created/modified records.
+    :param record_type: Accounts or Activities url.
+    :return:
+    """
+    column = 'id' if record_type == settings.accounts_url else 'accountid'
+    with dirty_accounts_lock:
+        write_dirty_accounts(set(read_dirty_accounts()) | {int(i) for i in df[column].dropna()})
+
+
+def clear_dirty_accounts(accountids):
+    """
+    Remove accounts from the dirty accounts once reporting_df has been rebuilt for them.
+    :param accountids: List of accountids that have been rebuilt.
+    :return:
+    """
+    with dirty_accounts_lock:
+        write_dirty_accounts(set(read_dirty_accounts()) - set(accountids))
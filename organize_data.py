@@ -1,6 +1,7 @@
 import client_directories_module as cdm
 import data_collection_module as dcm
 import data_manipulation_module as dmm
+import local_store_module as lsm
 import fy_reports_module as frm
 import V14_intake_module as im
 from shared_libs.settings_RSS import Settings
@@ -11,9 +12,11 @@ settings = Settings()
 
 
 
-def organize_data():
+def organize_data(full_rebuild=False, parallel=False):
     """
     Collects and organizes data and creates reporting files.
+    :param full_rebuild: Rebuild reporting_df for every account rather than only changed accounts. Default=False
+    :param parallel: Sync activity types at once and compute reporting features on every core. Default=False
     :return:
     """
     ap.automated_activity_updates()
@@ -21,15 +24,37 @@ def organize_data():
         im.complete_intake_process(settings.fred_authorization,
                                    settings.directory_path,
                                    settings.processed_documents_path)
-        dcm.collect_data()
+        dcm.collect_data(parallel)
     except KeyError:
         print("KeyError: We may have maxed out our allotted daily/monthly API calls. No new data will be exported.")
+    # Cleared only once the grant reports are written, so a failed run rebuilds the same accounts and cycles.
+    changed_accounts = lsm.read_dirty_accounts()
     while True:
         try:
-            dmm.form_reporting_df()
+            dmm.form_reporting_df(full_rebuild, parallel=parallel)
+            cdm.update_client_directories()
+            frm.update_fy_reports(parallel)
+            gr.write_grant_reports(changed_accounts, full_rebuild)
+            lsm.clear_dirty_accounts(changed_accounts)
+            break
+        except PermissionError:
+            run = input("File Permission Denied: Ensure that all necessary files "
+                        "are closed. Enter 'run' to try again when files are closed.")
+            if run.rstrip() == 'run':
+                continue
+
+
+def refresh_call_due(as_of=None):
+    """
+    Refresh call due, age and active training in reporting_df and the client directories without syncing or
+    rebuilding reporting_df.
+    :param as_of: Timestamp the columns are calculated from. Default=None uses the current time.
+    :return:
+    """
+    while True:
+        try:
+            dmm.refresh_reporting_df(as_of)
             cdm.update_client_directories()
-            frm.update_fy_reports()
-            gr.write_grant_reports()
             break
         except PermissionError:
             run = input("File Permission Denied: Ensure that all necessary files "
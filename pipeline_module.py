@@ -0,0 +1,266 @@
+import functools
+import hashlib
+import inspect
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from settings_RSS import Settings
+
+settings = Settings()
+
+
+class Stage:
+    """A step of a pipeline, declared with the values it reads and the value it produces."""
+
+    def __init__(self, name, function, inputs, args=(), output=None, grouped=False):
+        """
+        Declare a pipeline stage.
+        :param name: Name of the stage.
+        :param function: Function that produces the stage's output.
+        :param inputs: Names of the values the stage reads.
+        :param args: Arguments passed to the function ahead of the inputs. Default=()
+        :param output: Name of the value the stage produces. Default=None uses the stage name.
+        :param grouped: Pass the inputs as a single dictionary of input name and value. Default=False
+        """
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.args = tuple(args)
+        self.output = name if output is None else output
+        self.grouped = grouped
+
+    def run(self, input_values):
+        """
+        Run the stage's function on its inputs.
+        :param input_values: List of the stage's input values, in the order of its inputs.
+        :return: Output of the stage.
+        """
+        if self.grouped:
+            return self.function(*self.args, dict(zip(self.inputs, input_values)))
+        return self.function(*self.args, *input_values)
+
+
+def resolve_stage_levels(stages, values):
+    """
+    Group the stages into levels so that every stage runs after the stages producing its inputs. Stages in the same
+    level don't depend on each other.
+    :param stages: List of stages.
+    :param values: Dictionary of the pipeline's initial values.
+    :return: List of levels, each a list of stages, in the order they can run.
+    """
+    available = set(values)
+    outputs = {i.output for i in stages}
+    pending = list(stages)
+    levels = []
+    while len(pending) > 0:
+        ready = [i for i in pending if all(j in available for j in i.inputs)]
+        if len(ready) == 0:
+            missing = {j for i in pending for j in i.inputs if j not in available and j not in outputs}
+            raise ValueError(f"Pipeline can't be resolved. Missing inputs: {missing}" if len(missing) > 0 else
+                             f"Pipeline can't be resolved. Stages depend on each other: {[i.name for i in pending]}")
+        for stage in ready:
+            available.add(stage.output)
+            pending.remove(stage)
+        levels.append(ready)
+    return levels
+
+
+def hash_value(value):
+    """
+    Hash a pipeline value so a stage only reruns when its inputs change.
+    :param value: Dataframe, series or any value with a stable repr.
+    :return: Hex digest of the value.
+    """
+    digest = hashlib.sha256()
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+        digest.update(repr(value.dtypes.to_dict() if isinstance(value, pd.DataFrame) else value.dtype).encode())
+    else:
+        digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+def list_project_modules(module, found=None):
+    """
+    List a module and every module of this project it imports, directly or through other project modules.
+    :param module: Module defining a stage's function.
+    :param found: Dictionary of the modules listed so far, updated in place. Default=None
+    :return: Dictionary of module name and module.
+    """
+    found = {} if found is None else found
+    found[module.__name__] = module
+    project_path = os.path.dirname(os.path.abspath(__file__))
+    for value in vars(module).values():
+        path = getattr(value, '__file__', None)
+        if (inspect.ismodule(value) and value.__name__ not in found and path is not None and
+                os.path.dirname(os.path.abspath(path)) == project_path):
+            list_project_modules(value, found)
+    return found
+
+
+@functools.lru_cache(maxsize=None)
+def hash_module_code(module_name):
+    """
+    Hash the source of a module and of the project modules it imports, along with the settings they read, so a stage
+    reruns when any helper it calls or any setting it depends on changes. settings.now is left out, time relative
+    stages take it as an input.
+    :param module_name: Name of the module defining a stage's function.
+    :return: Hex digest of the modules, or None if their source can't be read.
+    """
+    if module_name not in sys.modules:
+        return None
+    digest = hashlib.sha256()
+    settings_names = set()
+    for name, module in sorted(list_project_modules(sys.modules[module_name]).items()):
+        try:
+            source = inspect.getsource(module)
+        except (OSError, TypeError):
+            return None
+        digest.update(source.encode())
+        settings_names.update(re.findall(r"settings\.(\w+)", source))
+    for name in sorted(settings_names - {'now'}):
+        digest.update(f"{name}={getattr(settings, name, None)!r}".encode())
+    return digest.hexdigest()
+
+
+def update_code_digest(digest, code):
+    """
+    Add a code object's bytecode, constants and names to a digest, including the code of nested functions.
+    :param digest: Hash object to update.
+    :param code: Code object.
+    :return:
+    """
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            update_code_digest(digest, const)
+        elif isinstance(const, frozenset):
+            # Set constants don't repr in a stable order between processes.
+            digest.update(repr(sorted(const, key=repr)).encode())
+        else:
+            digest.update(repr(const).encode())
+
+
+def hash_stage_code(function):
+    """
+    Hash the code a stage runs: its function's bytecode, constants and names, and the module the function is defined
+    in.
+    :param function: Function of the stage.
+    :return: Hex digest of the stage's code.
+    """
+    digest = hashlib.sha256()
+    code = getattr(function, '__code__', None)
+    if code is None:
+        digest.update(repr(function).encode())
+    else:
+        update_code_digest(digest, code)
+    digest.update(repr(hash_module_code(getattr(function, '__module__', None))).encode())
+    return digest.hexdigest()
+
+
+def hash_stage_inputs(stage, values, value_hashes):
+    """
+    Build the cache key of a stage from its code, arguments and the hashes of its inputs.
+    :param stage: Stage to key.
+    :param values: Dictionary of every value produced so far.
+    :param value_hashes: Dictionary of values already hashed during this run, updated in place.
+    :return: Cache key of the stage.
+    """
+    digest = hashlib.sha256(stage.name.encode())
+    digest.update(hash_stage_code(stage.function).encode())
+    digest.update(repr(stage.args).encode())
+    for i in stage.inputs:
+        if i not in value_hashes:
+            value_hashes[i] = hash_value(values[i])
+        digest.update(value_hashes[i].encode())
+    return digest.hexdigest()[:16]
+
+
+def get_stage_cache_file(cache_dir, stage, key):
+    """
+    Build the path of a stage's memoized output.
+    :param cache_dir: Directory of the pipeline's cache.
+    :param stage: Stage whose output is cached.
+    :param key: Cache key of the stage.
+    :return: Path of the cache file.
+    """
+    return os.path.join(cache_dir, f"{stage.name}-{key}.pkl")
+
+
+def write_stage_cache(cache_file, stage, value):
+    """
+    Memoize a stage's output, replacing its output from any earlier inputs.
+    :param cache_file: Path of the stage's cache file.
+    :param stage: Stage whose output is cached.
+    :param value: Output of the stage.
+    :return:
+    """
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    for f in os.listdir(cache_dir):
+        if f.startswith(f"{stage.name}-"):
+            os.remove(os.path.join(cache_dir, f))
+    pd.to_pickle(value, cache_file)
+
+
+def report_stage_timings(timings):
+    """
+    Print how long each stage took and whether it ran or was read from the cache.
+    :param timings: List of (stage name, status, seconds) tuples.
+    :return:
+    """
+    for name, status, seconds in timings:
+        print(f"-{name}: {status} in {seconds:.2f}s")
+    print(f"Pipeline Complete: {sum(i[2] for i in timings):.2f}s, "
+          f"{len([i for i in timings if i[1] == 'ran'])} of {len(timings)} stages ran.")
+
+
+def run_pipeline(stages, values, cache_name=None, refresh=False, parallel=False):
+    """
+    Run the stages of a pipeline in dependency order. When a cache name is given, each stage's output is memoized on
+    disk by a hash of its inputs, and a stage is only rerun when its inputs change. In parallel mode, the stages of a
+    level that need to run are computed at once in a process pool.
+    :param stages: List of stages.
+    :param values: Dictionary of the pipeline's initial values.
+    :param cache_name: Name of the pipeline's cache. Default=None runs every stage without caching.
+    :param refresh: Rerun every stage, replacing its memoized output. Default=False
+    :param parallel: Run independent stages in a process pool. Default=False
+    :return: Dictionary of the initial values and every stage's output.
+    """
+    values = dict(values)
+    value_hashes = {}
+    cache_dir = None if cache_name is None else os.path.join(settings.pipeline_cache_path, cache_name)
+    timings = []
+    executor = ProcessPoolExecutor(max_workers=settings.max_pipeline_workers) if parallel else None
+    try:
+        for level in resolve_stage_levels(stages, values):
+            pooled = executor is not None and len(level) > 1
+            running = []
+            for stage in level:
+                start = time.perf_counter()
+                cache_file = None
+                if cache_dir is not None:
+                    cache_file = get_stage_cache_file(cache_dir, stage, hash_stage_inputs(stage, values, value_hashes))
+                if cache_file is not None and not refresh and os.path.exists(cache_file):
+                    values[stage.output] = pd.read_pickle(cache_file)
+                    timings.append((stage.name, 'cached', time.perf_counter() - start))
+                    continue
+                input_values = [values[i] for i in stage.inputs]
+                if pooled:
+                    running.append((stage, cache_file, start, executor.submit(stage.run, input_values)))
+                else:
+                    running.append((stage, cache_file, start, stage.run(input_values)))
+            for stage, cache_file, start, result in running:
+                values[stage.output] = result.result() if pooled else result
+                if cache_file is not None:
+                    write_stage_cache(cache_file, stage, values[stage.output])
+                timings.append((stage.name, 'ran', time.perf_counter() - start))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    report_stage_timings(timings)
+    return values
@@ -0,0 +1,109 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import api_budget_module as abm
+from settings_RSS import Settings
+
+settings = Settings()
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+IDEMPOTENT_METHODS = ['GET', 'PUT', 'DELETE']
+
+
+def create_session():
+    """
+    Create a session that keeps connections to RSS open and reuses them across requests and threads.
+    :return: Session shared by every RSS request.
+    """
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=settings.max_concurrent_requests * settings.max_parallel_activity_types)
+    new_session.mount('https://', adapter)
+    new_session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return new_session
+
+
+session = create_session()
+
+
+def get_retry_delay(attempt, response=None):
+    """
+    Calculate how long to wait before retrying a request, honoring the Retry-After header if RSS sends one.
+    :param attempt: Number of attempts already made.
+    :param response: Response that failed, if any. Default=None
+    :return: Seconds to wait.
+    """
+    if response is not None and str(response.headers.get('Retry-After', '')).isdigit():
+        return int(response.headers['Retry-After'])
+    return settings.api_backoff_factor * (2 ** (attempt - 1))
+
+
+def rss_request(method, url, **kwargs):
+    """
+    Send a request to RSS through the shared session. Each attempt is counted against the API budget. Rate limited
+    (429) requests are always retried. Server errors and connection failures are only retried for idempotent methods
+    so an account or activity is never posted twice.
+    :param method: HTTP method.
+    :param url: Request url.
+    :param kwargs: Headers, data and other arguments passed to the session.
+    :return: Response from RSS.
+    """
+    kwargs.setdefault('timeout', settings.api_timeout)
+    retryable = method.upper() in IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+        attempt += 1
+        abm.acquire_api_call()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if not retryable or attempt > settings.api_max_retries:
+                raise
+            print(f"Connection to RSS failed, retrying {method} request. Attempt {attempt}")
+            time.sleep(get_retry_delay(attempt))
+            continue
+        retry = response.status_code == 429 or (retryable and response.status_code in RETRY_STATUS_CODES)
+        if not retry or attempt > settings.api_max_retries:
+            return response
+        print(f"RSS responded {response.status_code}, retrying {method} request. Attempt {attempt}")
+        time.sleep(get_retry_delay(attempt, response))
+
+
+def get(url, **kwargs):
+    """
+    Send a GET request to RSS.
+    :param url: Request url.
+    :param kwargs: Headers and other arguments passed to the session.
+    :return: Response from RSS.
+    """
+    return rss_request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    Send a POST request to RSS.
+    :param url: Request url.
+    :param kwargs: Headers, data and other arguments passed to the session.
+    :return: Response from RSS.
+    """
+    return rss_request('POST', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    """
+    Send a PATCH request to RSS.
+    :param url: Request url.
+    :param kwargs: Headers, data and other arguments passed to the session.
+    :return: Response from RSS.
+    """
+    return rss_request('PATCH', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    """
+    Send a DELETE request to RSS.
+    :param url: Request url.
+    :param kwargs: Headers and other arguments passed to the session.
+    :return: Response from RSS.
+    """
+    return rss_request('DELETE', url, **kwargs)
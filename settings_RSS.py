@@ -38,15 +38,36 @@ class Settings:
         self.record_limit = '?limit=100'
         self.starting_page = 1
         self.page_setting = f'&page={self.starting_page}'
+        self.records_per_page = 100
+        self.max_concurrent_requests = 4
+        self.max_parallel_activity_types = 4
+        self.stream_threshold = 5000
+        self.stream_chunk_pages = 20
+        self.max_pipeline_workers = None  # None uses every core
+
+        # Set API budget settings, None disables a limit
+        self.daily_api_limit = None
+        self.monthly_api_limit = None
+        self.api_requests_per_second = None
+        self.api_burst_size = 10
+        self.api_timeout = (10, 60)
+        self.api_max_retries = 4
+        self.api_backoff_factor = 2
 
         # Set file settings
         self.directory_path = os.getcwd()
         self.data_management_path = <ONE DRIVE DATA MANAGMENT PATH
         self.client_directory_path = fr"{self.directory_path}\client_directories"
         self.call_history = fr"{self.directory_path}\rss_data\api_call_history.json"
+        self.api_usage_history = fr"{self.directory_path}\rss_data\api_usage.json"
+        self.dirty_accounts_json = fr"{self.directory_path}\rss_data\dirty_accounts.json"
         self.accounts_csv = fr"{self.directory_path}\rss_data\accounts.csv"
         self.activities_csv = fr"{self.directory_path}\rss_data\Activities.csv"
         self.reporting_df_csv = fr"{self.directory_path}\rss_data\reporting_df.csv"
+        self.local_store_path = fr"{self.directory_path}\rss_data\local_store"
+        self.cache_path = fr"{self.directory_path}\rss_data\cache"
+        self.sync_checkpoint_path = fr"{self.directory_path}\rss_data\sync_checkpoint"
+        self.pipeline_cache_path = fr"{self.directory_path}\rss_data\pipeline_cache"
         self.processed_documents_path = fr"{self.directory_path}\Processed Documents"
         self.ch_client_directory = fr"{self.client_directory_path}\CH Client Directory 2.0.xlsx"
         self.ml_client_directory = fr"{self.client_directory_path}\ML Client Directory 2.0.xlsx"
@@ -58,6 +79,7 @@ class Settings:
         self.complete_client_directory = fr"{self.client_directory_path}\Complete Client Directory 2.0.xlsx"
         self.ytd_reports = fr"{self.directory_path}\ytd_reports"
         self.grant_reports_path = fr"{self.directory_path}\grant_reports"
+        self.grant_cycle_history = fr"{self.directory_path}\rss_data\grant_cycle_history.json"
         self.dol_wage_record = fr"{self.directory_path}\dol_wages.xlsx"
 
         # Set Activity Types Settings
@@ -80,17 +102,30 @@ class Settings:
                                     'CCS', 'CLP', 'TWIC']
 
         # Set Column Format Types
-        self.numeric_cols = ['children', 'initial_wage', 'current_wage',
-                             'previouswagehr', 'monthlyhhincome']
+        self.numeric_cols = ['children', 'initial_wage', 'current_wage', 'current_hours',
+                             'previouswagehr', 'previoushoursworked', 'monthlyhhincome']
+
+        # Set Record Schemas
+        # The local store is read as text, columns used as numbers are declared 'numeric'.
+        self.accounts_schema = {'id': 'numeric', 'ownerid': 'numeric', 'originalintakedate': 'datetime',
+                                'dob': 'datetime', 'createddate': 'datetime', 'modifieddate': 'datetime',
+                                'originaltrainingprogram': 'category', 'grantfund': 'category'}
+        self.activities_schema = {'id': 'numeric', 'accountid': 'numeric', 'date': 'datetime', 'startdate': 'datetime',
+                                  'createddate': 'datetime', 'modifieddate': 'datetime', 'type': 'category',
+                                  'trainingprogram': 'category', 'trainingstatus': 'category'}
 
         # Set Date Settings
         self.months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
                        'Oct', 'Nov', 'Dec']
+        self.fiscal_year_start_month = 7
         self.date_columns = ['Original Intake Date', 'Dob', 'Initial Startdate',
                              'Current Startdate', 'Last Retention Update',
                              'Last Date Retained', 'Cohort Date',
                              'Forklift Date', 'Cgsp Date', 'Dot Date',
                              'Btwt Date', 'Ccs Date', 'Clp Date', 'Cdl-A Date','Cdl-B Date','Twic Date']
+        self.rss_date_format = '%Y-%m-%d %H:%M:%S'
+        self.report_date_format = '%m/%d/%Y'
+        self.confirmation_date_format = '%m-%Y'
         # Set Program Settings
         self.programs = ["MTDL", "CF", "CTC", "OOO"]
 